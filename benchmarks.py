@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the hot paths of helper_functions.
+
+Every benchmark runs on synthetic data at one of several scales and records its best wall time
+and peak (Python + NumPy) memory. Results can be saved as a baseline and later runs compared against it,
+any benchmark that gets slower or uses more memory than the tolerance allows fails the run.
+
+Usage:
+  python benchmarks.py --scale small                                    # run and print the results
+  python benchmarks.py --scale medium --save-baseline baseline.json     # save a baseline
+  python benchmarks.py --scale medium --baseline baseline.json          # exit code 1 on regressions
+  python benchmarks.py --only make_windows make_windows_view            # run some of the benchmarks
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import helper_functions as hf
+
+# Sizes of the synthetic data at each scale
+
+SCALES = {
+  "small": {"series_length": 10_000, "corpus_mb": 1, "n_classes": 10, "n_samples": 10_000, "n_series": 10, "into_future": 30},
+  "medium": {"series_length": 1_000_000, "corpus_mb": 10, "n_classes": 100, "n_samples": 1_000_000, "n_series": 100, "into_future": 365},
+  "large": {"series_length": 100_000_000, "corpus_mb": 100, "n_classes": 1000, "n_samples": 10_000_000, "n_series": 500, "into_future": 365},
+}
+
+# Max seconds "import helper_functions" may take
+IMPORT_TIME_BUDGET = 1.0
+
+# Synthetic data generators
+
+def make_series(length, seed=42):
+  """
+  Returns a random walk of length float32 values (like a price series)
+  """
+  rng = np.random.default_rng(seed)
+  return (100 + np.cumsum(rng.normal(size=length))).astype(np.float32)
+
+def make_abstract_corpus(filename, size_mb, seed=42):
+  """
+  Writes a PubMed RCT style file of about size_mb megabytes to filename:
+  "###" ID lines, followed by "LABEL\\tsentence" lines and a blank line after each abstract
+  """
+  rng = random.Random(seed)
+  labels = ["BACKGROUND", "OBJECTIVE", "METHODS", "RESULTS", "CONCLUSIONS"]
+  words = ["patients", "treatment", "placebo", "randomized", "trial", "significant", "outcome", "group", "dose", "weeks"]
+  target_bytes = size_mb * 1024**2
+  written, abstract_id = 0, 0
+  with open(filename, "w") as f:
+    while written < target_bytes:
+      lines = [f"###{abstract_id}\n"]
+      for _ in range(rng.randint(5, 15)):
+        lines.append(f"{rng.choice(labels)}\t{' '.join(rng.choices(words, k=rng.randint(8, 30)))} .\n")
+      lines.append("\n")
+      chunk = "".join(lines)
+      f.write(chunk)
+      written += len(chunk)
+      abstract_id += 1
+  return filename
+
+def make_labels(n_samples, n_classes, accuracy=0.7, seed=42):
+  """
+  Returns random truth labels and predictions which are right about accuracy of the time
+  """
+  rng = np.random.default_rng(seed)
+  y_true = rng.integers(0, n_classes, size=n_samples)
+  y_pred = np.where(rng.random(n_samples) < accuracy, y_true, rng.integers(0, n_classes, size=n_samples))
+  return y_true, y_pred
+
+def make_tiny_model(window_size, horizon=1):
+  """
+  Returns a small untrained Keras model which stands in for a real forecasting model
+  """
+  import tensorflow as tf
+  model = tf.keras.Sequential([tf.keras.Input(shape=(window_size,)),
+                               tf.keras.layers.Dense(16, activation="relu"),
+                               tf.keras.layers.Dense(horizon)])
+  model.compile(loss="mae", optimizer="adam")
+  return model
+
+# Benchmarks, each one takes the scale's sizes and a temporary directory, does its setup
+# and returns the function to time
+
+BENCHMARKS = {}
+
+def benchmark(name):
+  def register(setup):
+    BENCHMARKS[name] = setup
+    return setup
+  return register
+
+@benchmark("make_windows")
+def bench_make_windows(sizes, tmp_dir):
+  series = make_series(sizes["series_length"])
+  return lambda: hf.make_windows(series)
+
+@benchmark("make_windows_view")
+def bench_make_windows_view(sizes, tmp_dir):
+  series = make_series(sizes["series_length"])
+  return lambda: hf.make_windows_view(series)
+
+@benchmark("preprocess_text_with_line_numbers")
+def bench_preprocess_text(sizes, tmp_dir):
+  corpus = make_abstract_corpus(os.path.join(tmp_dir, "corpus.txt"), sizes["corpus_mb"])
+  return lambda: hf.preprocess_text_with_line_numbers(corpus)
+
+@benchmark("preprocess_text_with_line_numbers_parallel")
+def bench_preprocess_text_parallel(sizes, tmp_dir):
+  corpus = make_abstract_corpus(os.path.join(tmp_dir, "corpus.txt"), sizes["corpus_mb"])
+  return lambda: hf.preprocess_text_with_line_numbers_parallel(corpus)
+
+@benchmark("make_future_forecasts")
+def bench_make_future_forecasts(sizes, tmp_dir):
+  series = make_series(sizes["series_length"])
+  model = make_tiny_model(hf.WINDOW_SIZE)
+  return lambda: hf.make_future_forecasts(series, model, sizes["into_future"], verbose=False)
+
+@benchmark("make_future_forecasts_batched")
+def bench_make_future_forecasts_batched(sizes, tmp_dir):
+  series = np.stack([make_series(hf.WINDOW_SIZE * 10, seed=seed) for seed in range(sizes["n_series"])])
+  model = make_tiny_model(hf.WINDOW_SIZE)
+  return lambda: hf.make_future_forecasts_batched(series, model, sizes["into_future"])
+
+@benchmark("calculate_results_time_series")
+def bench_calculate_results_time_series(sizes, tmp_dir):
+  y_true = make_series(sizes["series_length"])
+  y_preds = y_true + np.random.default_rng(0).normal(size=len(y_true)).astype(np.float32)
+  return lambda: hf.calculate_results_time_series(y_true, y_preds)
+
+@benchmark("evaluate_time_series_models")
+def bench_evaluate_time_series_models(sizes, tmp_dir):
+  y_true = make_series(sizes["series_length"] // 10)
+  y_preds = y_true + np.random.default_rng(0).normal(size=(10, len(y_true))).astype(np.float32)
+  return lambda: hf.evaluate_time_series_models(y_true, y_preds)
+
+@benchmark("make_confusion_matrix")
+def bench_make_confusion_matrix(sizes, tmp_dir):
+  import matplotlib
+  matplotlib.use("Agg")
+  import matplotlib.pyplot as plt
+  y_true, y_pred = make_labels(sizes["n_samples"], sizes["n_classes"])
+  savefig = os.path.join(tmp_dir, "confusion_matrix.png")
+  def run():
+    hf.make_confusion_matrix(y_true, y_pred, savefig=savefig)
+    plt.close("all")
+  return run
+
+@benchmark("confusion_matrix_accumulator")
+def bench_confusion_matrix_accumulator(sizes, tmp_dir):
+  y_true, y_pred = make_labels(sizes["n_samples"], sizes["n_classes"])
+  def run():
+    cm_accumulator = hf.ConfusionMatrixAccumulator(sizes["n_classes"])
+    for start in range(0, len(y_true), 100_000):
+      cm_accumulator.update(y_true[start:start+100_000], y_pred[start:start+100_000])
+    return cm_accumulator.cm
+  return run
+
+# Timing and memory measurement
+
+def measure_import_time(repeat=3):
+  """
+  Returns the best time in seconds "import helper_functions" takes in a fresh interpreter
+  """
+  code = "import time; start = time.perf_counter(); import helper_functions; print(time.perf_counter() - start)"
+  package_dir = os.path.dirname(os.path.abspath(__file__))
+  times = []
+  for _ in range(repeat):
+    output = subprocess.run([sys.executable, "-c", code], cwd=package_dir, capture_output=True, text=True, check=True)
+    times.append(float(output.stdout.strip().splitlines()[-1]))
+  return min(times)
+
+def run_benchmark(name, sizes, tmp_dir, repeat=3):
+  """
+  Returns the best wall time (seconds) of repeat runs of benchmark name and its peak traced memory (bytes)
+  """
+  run = BENCHMARKS[name](sizes, tmp_dir)
+  run() # warm up (imports, tf.function tracing, caches)
+
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    run()
+    times.append(time.perf_counter() - start)
+
+  # Measure memory in a separate run, tracing allocations slows them down
+  tracemalloc.start()
+  run()
+  _, peak_memory = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return {"seconds": min(times), "peak_bytes": peak_memory}
+
+def compare_to_baseline(results, baseline, tolerance):
+  """
+  Returns the list of (benchmark, metric, baseline value, new value) which got worse than baseline by more than tolerance
+  """
+  regressions = []
+  for name, result in results.items():
+    if name not in baseline:
+      continue
+    for metric in ("seconds", "peak_bytes"):
+      if metric in result and metric in baseline[name] and result[metric] > baseline[name][metric] * (1 + tolerance):
+        regressions.append((name, metric, baseline[name][metric], result[metric]))
+  return regressions
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark the hot paths of helper_functions.")
+  parser.add_argument("--scale", choices=SCALES, default="small", help="size of the synthetic data (default: small)")
+  parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="only run these benchmarks")
+  parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark, the best is kept (default: 3)")
+  parser.add_argument("--baseline", help="JSON file of previous results to compare against")
+  parser.add_argument("--save-baseline", help="save the results to this JSON file")
+  parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown/memory growth over the baseline (default: 0.25)")
+  parser.add_argument("--import-budget", type=float, default=IMPORT_TIME_BUDGET, help="max seconds importing helper_functions may take")
+  args = parser.parse_args(argv)
+
+  failures = []
+  results = {}
+  import_seconds = measure_import_time()
+  results[f"import_helper_functions[{args.scale}]"] = {"seconds": import_seconds}
+  print(f"{'import helper_functions':<50} {import_seconds:>10.4f}s")
+  if import_seconds > args.import_budget:
+    failures.append(f"importing helper_functions took {import_seconds:.3f}s, over the {args.import_budget:.3f}s budget")
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    for name in args.only or BENCHMARKS:
+      try:
+        result = run_benchmark(name, SCALES[args.scale], tmp_dir, repeat=args.repeat)
+      except Exception as e:
+        failures.append(f"{name} raised {type(e).__name__}: {e}")
+        print(f"{name:<50} {'error':>11}")
+        continue
+      results[f"{name}[{args.scale}]"] = result
+      print(f"{name:<50} {result['seconds']:>10.4f}s {result['peak_bytes'] / 1024**2:>10.1f}MB")
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    for name, metric, old, new in compare_to_baseline(results, baseline, args.tolerance):
+      failures.append(f"{name} {metric} regressed: {old:.4g} -> {new:.4g} ({new / old - 1:+.0%})")
+
+  if args.save_baseline:
+    baseline = {}
+    if os.path.exists(args.save_baseline):
+      with open(args.save_baseline) as f:
+        baseline = json.load(f)
+    baseline.update(results)
+    with open(args.save_baseline, "w") as f:
+      json.dump(baseline, f, indent=2, sort_keys=True)
+
+  for failure in failures:
+    print(f"FAIL: {failure}", file=sys.stderr)
+  return 1 if failures else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -9,50 +9,288 @@ Original file is located at
 # Helper Functions
 """
 
-import tensorflow as tf
-import pandas as pd
-import matplotlib.pyplot as plt
+import array
+import collections
+import contextlib
+import datetime
+import fnmatch
+import functools
+import glob
+import hashlib
+import importlib
+import inspect
+import io
+import itertools
+import json
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import weakref
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 
+# Import heavy dependencies lazily
+
+class _LazyModule:
+  """
+  Stands in for a heavy module (TensorFlow, pandas, matplotlib, sklearn) and only imports it the first time
+  one of its attributes is used, so importing helper_functions stays fast for code that doesn't need it.
+  Once imported, the module replaces this stand-in in the module globals so later lookups cost nothing extra.
+  """
+  def __init__(self, name, alias):
+    self._name = name
+    self._alias = alias
+    self._module = None
+
+  def __getattr__(self, attr):
+    if self._module is None:
+      self._module = importlib.import_module(self._name)
+      globals()[self._alias] = self._module
+    return getattr(self._module, attr)
+
+tf = _LazyModule("tensorflow", "tf")
+pd = _LazyModule("pandas", "pd")
+plt = _LazyModule("matplotlib.pyplot", "plt")
+mpimg = _LazyModule("matplotlib.image", "mpimg")
+sklearn_metrics = _LazyModule("sklearn.metrics", "sklearn_metrics")
+
+# Profile the helper functions (opt-in)
+
+_profiling_enabled = False
+_profile_stats = {}
+
+def enable_profiling():
+  """
+  Starts recording call counts, latencies and bytes read of the helper functions (see get_profile_stats).
+  """
+  global _profiling_enabled
+  _profiling_enabled = True
+
+def disable_profiling():
+  """
+  Stops recording, the helper functions then only pay for a single flag check per call.
+  """
+  global _profiling_enabled
+  _profiling_enabled = False
+
+def reset_profile_stats():
+  """
+  Forgets everything recorded so far.
+  """
+  _profile_stats.clear()
+
+def _record_call(name, seconds, bytes_read=0):
+  stats = _profile_stats.get(name)
+  if stats is None:
+    stats = _profile_stats[name] = {"calls": 0, "total_seconds": 0., "bytes_read": 0,
+                                    "latencies": collections.deque(maxlen=10_000)} # recent latencies for the percentiles
+  stats["calls"] += 1
+  stats["total_seconds"] += seconds
+  stats["bytes_read"] += bytes_read
+  stats["latencies"].append(seconds)
+
+def _file_size(arguments):
+  """
+  Size in bytes of the file named by a call's first argument (0 if it isn't a filepath string),
+  the bytes_read of functions reading that file
+  """
+  filename = next(iter(arguments.values()), None)
+  return os.path.getsize(filename) if isinstance(filename, str) and os.path.isfile(filename) else 0
+
+def _inside_graph_trace():
+  """
+  Whether TensorFlow is tracing a graph (e.g. a function passed to tf.data.Dataset.map) rather than running eagerly
+  """
+  tf_module = sys.modules.get("tensorflow") # don't import TensorFlow just to find out it isn't tracing
+  return tf_module is not None and tf_module.inside_function()
+
+def profiled(function=None, bytes_read=None):
+  """
+  Decorator recording every call of function while profiling is enabled (see enable_profiling).
+  Calls made while TensorFlow traces a graph (e.g. inside tf.data.Dataset.map) aren't recorded, they
+  run once to build the graph and the graph's executions can't be seen from Python.
+  Args:
+    function: function to profile
+    bytes_read: function taking a dictionary of the call's arguments by parameter name (defaults filled in)
+      which returns how many bytes the call will read, it's called before function runs (default=None)
+  """
+  def decorate(function):
+    name = function.__name__
+    signature = inspect.signature(function)
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      if not _profiling_enabled or _inside_graph_trace():
+        return function(*args, **kwargs)
+      call_bytes_read = 0
+      if bytes_read is not None:
+        try:
+          arguments = signature.bind(*args, **kwargs)
+          arguments.apply_defaults()
+          call_bytes_read = bytes_read(arguments.arguments)
+        except Exception: # profiling never breaks the call, function raises its own error for bad arguments
+          pass
+      start = time.perf_counter()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        _record_call(name, time.perf_counter() - start, call_bytes_read)
+    return wrapper
+  return decorate(function) if function is not None else decorate
+
+@contextlib.contextmanager
+def profile_section(name):
+  """
+  Context manager recording the time spent in its block under name while profiling is enabled,
+  e.g. with profile_section("evaluate"): model.evaluate(test_data)
+  """
+  if not _profiling_enabled:
+    yield
+    return
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    _record_call(name, time.perf_counter() - start)
+
+def get_profile_stats():
+  """
+  Returns a dictionary of function/section name -> calls, total, mean, p50, p90, p99 and max latency (seconds) and bytes read.
+  """
+  profile_stats = {}
+  for name, stats in _profile_stats.items():
+    latencies = np.array(stats["latencies"])
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    profile_stats[name] = {"calls": stats["calls"],
+                           "total_seconds": stats["total_seconds"],
+                           "mean_seconds": stats["total_seconds"] / stats["calls"],
+                           "p50_seconds": float(p50),
+                           "p90_seconds": float(p90),
+                           "p99_seconds": float(p99),
+                           "max_seconds": float(latencies.max()),
+                           "bytes_read": stats["bytes_read"]}
+  return profile_stats
+
+def save_profile_stats(filename=None):
+  """
+  Returns the profile stats (see get_profile_stats) as a JSON string and writes them to filename if it's passed.
+  """
+  profile_json = json.dumps(get_profile_stats(), indent=2, sort_keys=True)
+  if filename is not None:
+    with open(filename, "w") as f:
+      f.write(profile_json)
+  return profile_json
+
+def write_profile_stats_to_tensorboard(log_dir, step=0):
+  """
+  Writes the profile stats as TensorBoard scalars (e.g. "load_and_prep_image/p90_seconds") to log_dir/profile.
+  log_dir can also be a callback made by create_tensorboard_callback, its log directory is then used.
+  """
+  log_dir = getattr(log_dir, "log_dir", log_dir)
+  writer = tf.summary.create_file_writer(os.path.join(log_dir, "profile"))
+  with writer.as_default():
+    for name, stats in get_profile_stats().items():
+      for metric, value in stats.items():
+        tf.summary.scalar(f"{name}/{metric}", value, step=step)
+  writer.flush()
+  writer.close()
+
 # Plot Loss and Accuracy graphs separately.
 
-def plot_loss_curves(history):
+@profiled
+def plot_loss_curves(history, axes=None, max_points=None, method="minmax"):
   """
   Returns separate curves for training and validation metrics
+  history can be a History object or its history dictionary.
+  axes: two matplotlib Axes to plot the loss and accuracy on, by default they're plotted
+  on the current figure and a new figure (default=None)
+  max_points: downsample long (e.g. per step) histories to about this many points per curve (default=None)
+  method: downsampling method, "minmax" or "lttb" (see downsample_for_plot) (default="minmax")
   """
-  loss = history.history["loss"]
-  accuracy = history.history["accuracy"]
-  val_loss = history.history["val_loss"]
-  val_accuracy = history.history["val_accuracy"]
+  history = getattr(history, "history", history)
+  loss = history["loss"]
+  accuracy = history["accuracy"]
+  val_loss = history["val_loss"]
+  val_accuracy = history["val_accuracy"]
   
   # Number of epochs
-  epochs = range(len(history.history["loss"]))
+  epochs = np.arange(len(history["loss"]))
+  loss_epochs, (loss, val_loss) = _downsample_curves(epochs, [loss, val_loss], max_points, method)
+  accuracy_epochs, (accuracy, val_accuracy) = _downsample_curves(epochs, [accuracy, val_accuracy], max_points, method)
 
   # Plot the loss
-  plt.plot(epochs,loss,label="Training Loss")
-  plt.plot(epochs,val_loss,label="Validation Loss")
-  plt.title("Loss")
-  plt.xlabel("Epochs")
-  plt.legend()
+  loss_ax = plt.gca() if axes is None else axes[0]
+  loss_ax.plot(loss_epochs,loss,label="Training Loss")
+  loss_ax.plot(loss_epochs,val_loss,label="Validation Loss")
+  loss_ax.set_title("Loss")
+  loss_ax.set_xlabel("Epochs")
+  loss_ax.legend()
 
   # Plot the accuracy
-  plt.figure()
-  plt.plot(epochs,accuracy,label="Training Accuracy")
-  plt.plot(epochs,val_accuracy,label="Validation Accuracy")
-  plt.title("Accuracy")
-  plt.xlabel("Epochs")
-  plt.legend();
+  if axes is None:
+    plt.figure()
+  accuracy_ax = plt.gca() if axes is None else axes[1]
+  accuracy_ax.plot(accuracy_epochs,accuracy,label="Training Accuracy")
+  accuracy_ax.plot(accuracy_epochs,val_accuracy,label="Validation Accuracy")
+  accuracy_ax.set_title("Accuracy")
+  accuracy_ax.set_xlabel("Epochs")
+  accuracy_ax.legend();
+
+def _downsample_curves(epochs, curves, max_points, method):
+  """
+  Downsamples curves (same length lists) sharing epochs together with downsample_for_plot if max_points is set
+  """
+  if max_points is None:
+    return epochs, curves
+  epochs, curves = downsample_for_plot(epochs, np.column_stack(curves), max_points=max_points, method=method)
+  return epochs, list(curves.T)
 
 # Preprocesses images and reshapes into a shape which can be recognized by model to predict
 
-def load_and_prep_image(filename, img_shape=224, scale=True):
+def _image_bytes_read(arguments):
+  """
+  bytes_read of load_and_prep_image, nothing is read from filename when the image is cached
+  """
+  cache = arguments["cache"]
+  if cache is not None and isinstance(arguments["filename"], str) and \
+     cache.make_key(arguments["filename"], arguments["img_shape"], arguments["scale"]) in cache:
+    return 0
+  return _file_size(arguments)
+
+@profiled(bytes_read=_image_bytes_read)
+def load_and_prep_image(filename, img_shape=224, scale=True, cache=None):
   """
   Reads an image from filename, turns it into a tensor and reshapes it to (img_shape,img_shape,color_channels)
+  If a PreppedImageCache is passed as cache, already preprocessed images are read from it instead of being
+  decoded again (only works when filename is a Python string, not inside a tf.data pipeline).
   """
+  # Check the cache for the preprocessed image
+  if cache is not None:
+    key = cache.make_key(filename, img_shape, scale)
+    img = cache.get(key)
+    if img is not None:
+      return tf.convert_to_tensor(img)
+
   # Read an image
   img = tf.io.read_file(filename)
+  img = decode_and_prep_image(img, img_shape=img_shape, scale=scale)
+  if cache is not None:
+    cache.put(key, img.numpy())
+  return img
+
+@profiled
+def decode_and_prep_image(img, img_shape=224, scale=True):
+  """
+  Turns the raw bytes of an image file into a tensor reshaped to (img_shape,img_shape,color_channels), see load_and_prep_image
+  """
   # Decode the read file into tensor
-  img = tf.image.decode_image(img, channels=3) # added channels param if it's a png file because png has 4 color channels
+  img = tf.image.decode_image(img, channels=3, expand_animations=False) # added channels param if it's a png file because png has 4 color channels, expand_animations keeps gifs 3D
   # Resize the image
   img = tf.image.resize(img,[img_shape,img_shape])
   # Rescale the image and get all values between 0 and 1
@@ -62,18 +300,264 @@ def load_and_prep_image(filename, img_shape=224, scale=True):
   else:
     return img
 
+# Cache preprocessed images in memory and on disk
+
+class PreppedImageCache:
+  """
+  Cache of preprocessed images for load_and_prep_image so repeated evaluations skip decoding the image files.
+  Images are kept in a least recently used in-memory tier and a size bounded on-disk tier of .npy files
+  (memory-mapped when read back). Keys are made from the filepath, its modification time, img_shape and scale,
+  so an edited file or different preprocessing settings never return a stale image.
+  Args:
+    cache_dir: directory to store the .npy files in, None for an in-memory only cache (default=None)
+    max_memory_items: number of images kept in memory (default=1024)
+    max_disk_bytes: size the on-disk tier is kept under, least recently used files are deleted first (default=10GB)
+  Example usage:
+    image_cache = PreppedImageCache("image_cache/")
+    img = load_and_prep_image("03-pizza-dad.jpeg", cache=image_cache)
+  """
+  def __init__(self, cache_dir=None, max_memory_items=1024, max_disk_bytes=10 * 1024**3):
+    self.cache_dir = cache_dir
+    self.max_memory_items = max_memory_items
+    self.max_disk_bytes = max_disk_bytes
+    self._memory = collections.OrderedDict()
+    if cache_dir is not None:
+      os.makedirs(cache_dir, exist_ok=True)
+      self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith(".npy"))
+
+  @staticmethod
+  def make_key(filename, img_shape, scale):
+    """
+    Returns the cache key of filename preprocessed with img_shape and scale.
+    """
+    filename = os.path.abspath(filename)
+    return f"{filename}|{os.stat(filename).st_mtime_ns}|{img_shape}|{bool(scale)}"
+
+  def _disk_path(self, key):
+    return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+  def _add_to_memory(self, key, img):
+    self._memory[key] = img
+    self._memory.move_to_end(key)
+    while len(self._memory) > self.max_memory_items:
+      self._memory.popitem(last=False)
+
+  def __contains__(self, key):
+    return key in self._memory or (self.cache_dir is not None and os.path.exists(self._disk_path(key)))
+
+  def get(self, key):
+    """
+    Returns the cached image for key (memory first, then disk) or None if it isn't cached.
+    """
+    if key in self._memory:
+      self._memory.move_to_end(key)
+      return self._memory[key]
+    if self.cache_dir is None:
+      return None
+    path = self._disk_path(key)
+    try:
+      img = np.load(path, mmap_mode="r")
+      os.utime(path) # mark the file as recently used
+    except (FileNotFoundError, ValueError): # missing, evicted or partially written
+      return None
+    self._add_to_memory(key, img)
+    return img
+
+  def put(self, key, img):
+    """
+    Adds a preprocessed image to the cache, evicting the least recently used images if the cache is full.
+    """
+    img = np.asarray(img)
+    self._add_to_memory(key, img)
+    if self.cache_dir is None:
+      return
+    # Write to a temporary file of our own and rename it so other processes sharing cache_dir never read half a file
+    path = self._disk_path(key)
+    fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+    try:
+      with os.fdopen(fd, "wb") as f:
+        np.save(f, img)
+      new_size = os.path.getsize(tmp_path)
+      try:
+        old_size = os.path.getsize(path) # overwriting an entry doesn't grow the cache
+      except FileNotFoundError:
+        old_size = 0
+      os.replace(tmp_path, path)
+    except OSError: # e.g. another process holds path open on Windows, the image stays cached in memory
+      try:
+        os.remove(tmp_path)
+      except FileNotFoundError:
+        pass
+      return
+    self._disk_bytes += new_size - old_size
+    if self._disk_bytes > self.max_disk_bytes:
+      self._evict()
+
+  def _evict(self):
+    # Recount from the directory in case other processes are sharing it
+    entries = []
+    for entry in os.scandir(self.cache_dir):
+      if entry.name.endswith(".npy"):
+        try:
+          stat = entry.stat()
+        except FileNotFoundError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    self._disk_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if self._disk_bytes <= self.max_disk_bytes:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      self._disk_bytes -= size
+
+# Load many images as a batched, prefetched tf.data pipeline
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif")
+
+@profiled
+def list_image_files(paths):
+  """
+  Turns paths into a sorted list of image filepaths.
+  Args:
+    paths: a list of filepaths, a glob pattern (e.g. "data/*/*.jpg"), a directory
+      laid out like walk_through_dir expects (e.g. "data/train/" with a subdirectory per class)
+      or an index made by scan_image_dir
+  Returns:
+    A list of image filepaths (directories are searched recursively for IMAGE_EXTENSIONS files)
+  """
+  if isinstance(paths, dict):
+    return [path for class_name in sorted(paths) for path in paths[class_name]["paths"]]
+  if not isinstance(paths, str):
+    return list(paths)
+  if os.path.isdir(paths):
+    image_files = []
+    for dirpath, dirnames, filenames in os.walk(paths):
+      image_files.extend(os.path.join(dirpath, filename) for filename in filenames
+                         if filename.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(image_files)
+  return sorted(glob.glob(paths))
+
+@profiled
+def load_and_prep_image_dataset(paths, img_shape=224, scale=True, batch_size=32,
+                                cache=False, deterministic=True, zip_file=None):
+  """
+  Creates a batched tf.data.Dataset of images preprocessed exactly like load_and_prep_image.
+  Files are decoded and resized in parallel and batches are prefetched so the model isn't starved.
+  Args:
+    paths: list of filepaths, glob pattern or directory (see list_image_files)
+    img_shape: size to resize images to (img_shape, img_shape) (default=224)
+    scale: rescale pixel values to be between 0 and 1 (default=True)
+    batch_size: number of images per batch (default=32)
+    cache: False for no caching, True to cache decoded images in memory or a filepath to cache them on disk (default=False)
+    deterministic: keep the images in the same order as paths (default=True),
+      set to False to trade ordering for throughput
+    zip_file: read the images straight out of this zip file instead of the filesystem,
+      paths are then a list of member names or a scan_image_dir index of the zip file (default=None)
+  Returns:
+    A tf.data.Dataset yielding batches of shape (batch_size, img_shape, img_shape, 3),
+    can be passed straight to model.predict
+  Example usage:
+    test_data = load_and_prep_image_dataset("pizza_steak/test/")
+    pred_probs = model.predict(test_data)
+  """
+  image_files = list_image_files(paths)
+  if zip_file is None:
+    dataset = tf.data.Dataset.from_tensor_slices(image_files)
+    dataset = dataset.map(lambda filename: load_and_prep_image(filename, img_shape=img_shape, scale=scale),
+                          num_parallel_calls=tf.data.AUTOTUNE,
+                          deterministic=deterministic)
+  else:
+    # Read the raw bytes out of the zip file one after the other, decode them in parallel
+    def read_members():
+      with zipfile.ZipFile(zip_file, "r") as zip_ref:
+        for member in image_files:
+          yield zip_ref.read(member)
+    dataset = tf.data.Dataset.from_generator(read_members, output_signature=tf.TensorSpec(shape=(), dtype=tf.string))
+    dataset = dataset.map(lambda img: decode_and_prep_image(img, img_shape=img_shape, scale=scale),
+                          num_parallel_calls=tf.data.AUTOTUNE,
+                          deterministic=deterministic)
+  # Cache decoded images so later epochs/evaluations skip reading and decoding
+  if cache:
+    dataset = dataset.cache("" if cache is True else cache)
+  return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+# Make predictions on many images at once and cache them
+
+@profiled
+def pred_probs_to_labels(pred_probs):
+  """
+  Turns prediction probabilities into integer class labels.
+  Sigmoid outputs (last dimension of 1) are rounded, softmax outputs use argmax.
+  """
+  pred_probs = np.asarray(pred_probs)
+  if pred_probs.ndim > 1 and pred_probs.shape[-1] > 1:
+    return np.argmax(pred_probs, axis=-1)
+  return np.round(pred_probs).reshape(len(pred_probs), -1)[:, 0].astype(int)
+
+def _class_probabilities(pred_prob):
+  """
+  Turns the prediction probabilities of one sample into one probability per class,
+  a sigmoid output p becomes [1 - p, p].
+  """
+  pred_prob = np.asarray(pred_prob).reshape(-1)
+  if len(pred_prob) == 1:
+    return np.array([1 - pred_prob[0], pred_prob[0]])
+  return pred_prob
+
+@profiled
+def make_prediction_cache(model, images, keys=None, batch_size=32, img_shape=224, scale=True):
+  """
+  Predicts on all images with as few forward passes as possible and caches the prediction probabilities.
+  Args:
+    model: trained model to make predictions with
+    images: array/tensor of images, tf.data.Dataset of batched images or a list of image filepaths
+      (filepaths are loaded with load_and_prep_image_dataset)
+    keys: keys for each image in the cache (default: the image filepaths if images are filepaths, otherwise image indexes)
+    batch_size: number of images per forward pass (default=32)
+    img_shape, scale: preprocessing of image filepaths, see load_and_prep_image (default=224, True)
+  Returns:
+    A dictionary of key -> prediction probabilities which pred_and_plot, plot_image and
+    plot_multiple_predictions can read from instead of calling model.predict.
+  Example usage:
+    pred_cache = make_prediction_cache(model, test_images)
+    plot_image(0, model, test_labels, test_images, class_names, pred_cache=pred_cache)
+  """
+  if isinstance(images, (list, tuple)) and images and isinstance(images[0], str):
+    if keys is None:
+      keys = list(images)
+    images = load_and_prep_image_dataset(images, img_shape=img_shape, scale=scale, batch_size=batch_size, deterministic=True)
+
+  # One call to predict, Keras splits it into batch_size forward passes
+  if isinstance(images, tf.data.Dataset):
+    pred_probs = model.predict(images, verbose=0)
+  else:
+    pred_probs = model.predict(images, batch_size=batch_size, verbose=0)
+
+  if keys is None:
+    keys = range(len(pred_probs))
+  return dict(zip(keys, pred_probs))
+
 # Predict and Plot the reshaped image
 
-def pred_and_plot(model,filename,class_names):
+@profiled
+def pred_and_plot(model,filename,class_names,pred_cache=None):
   """
-  Imports image located in filename, predicts image class with model, and plots the image with the predicted class as the title
+  Imports image located in filename, predicts image class with model, and plots the image with the predicted class as the title.
+  Works for binary (sigmoid) and multi-class (softmax) models.
+  If pred_cache (see make_prediction_cache) contains filename, its cached prediction is used instead of calling the model.
   """
   # Preprocess the image
   img = load_and_prep_image(filename)
-  # Make prediction on the image
-  pred_prob = model.predict(tf.expand_dims(img, axis=0))
+  # Make prediction on the image (or read it from the cache)
+  if pred_cache is not None and filename in pred_cache:
+    pred_prob = np.expand_dims(pred_cache[filename], axis=0)
+  else:
+    pred_prob = model.predict(tf.expand_dims(img, axis=0), verbose=0)
   # Find the prediction class
-  pred_class = class_names[int(tf.round(pred_prob)[0][0])]
+  pred_class = class_names[pred_probs_to_labels(pred_prob)[0]]
   # Plot the image with the predicted class as title
   plt.imshow(img)
   plt.title(f"Prediction : {pred_class}")
@@ -81,11 +565,11 @@ def pred_and_plot(model,filename,class_names):
 
 # View Random Image from a target folder
 
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-import random
-
-def view_random_image(target_dir,target_class):
+@profiled
+def view_random_image(target_dir,target_class,ax=None):
+  """
+  Plots (on ax, default the current Axes) and returns a random image from target_dir + target_class
+  """
   # Setup the target directory (view image from here)
   target_folder = target_dir + target_class
 
@@ -95,9 +579,11 @@ def view_random_image(target_dir,target_class):
 
   # Read the image and plot it
   img = mpimg.imread(target_folder + "/" + random_image[0]) #random_image[0] gives value without strings
-  plt.imshow(img)
-  plt.title(target_class)
-  plt.axis("off");
+  if ax is None:
+    ax = plt.gca()
+  ax.imshow(img)
+  ax.set_title(target_class)
+  ax.axis("off");
 
   print(f"Image shape : {img.shape}") # Shape of an image
 
@@ -105,29 +591,55 @@ def view_random_image(target_dir,target_class):
 
 # Plot Decision Boundary Curve for non-linear data
 
-def plot_decision_boundary(model,X,y):
+@profiled
+def predict_classes_in_chunks(model, x_in, chunk_size=100_000):
+  """
+  Predicts integer class labels for x_in, chunk_size rows at a time so memory stays bounded.
+  Returns the labels and whether the model is multi-class.
+  """
+  y_preds = np.empty(len(x_in), dtype=int)
+  multi_class = False
+  for start in range(0, len(x_in), chunk_size):
+    pred_probs = model.predict(x_in[start:start+chunk_size], verbose=0)
+    multi_class = pred_probs.ndim > 1 and pred_probs.shape[-1] > 1
+    y_preds[start:start+chunk_size] = pred_probs_to_labels(pred_probs)
+  return y_preds, multi_class
+
+@profiled
+def plot_decision_boundary(model,X,y,resolution=100,chunk_size=100_000,refine_factor=None):
   """
   Plots the model's performance/decision boundary based on predictions on X
+  Args:
+    model: trained model to plot the decision boundary of
+    X: 2D input features
+    y: labels of X
+    resolution: number of grid points along each axis (default=100)
+    chunk_size: max number of grid points predicted on at once (default=100_000)
+    refine_factor: if set (e.g. 8), first predicts on a grid refine_factor times coarser and
+      only predicts on the full resolution grid inside coarse cells whose corners disagree
+      about the class, the rest of the grid is filled in from the coarse grid (default=None)
   """
   # Define the axis boundary via a meshgrid
   x_min,x_max = X[:,0].min(),X[:,0].max()
   y_min,y_max = X[:,1].min(),X[:,1].max()
-  xx,yy = np.meshgrid(np.linspace(x_min,x_max,100),
-                      np.linspace(y_min,y_max,100))
+  xx,yy = np.meshgrid(np.linspace(x_min,x_max,resolution),
+                      np.linspace(y_min,y_max,resolution))
   
   # Creating X values (predicting on these values)
   x_in = np.c_[xx.ravel(),yy.ravel()]
 
   # Make predictions
-  y_preds = model.predict(x_in)
+  if refine_factor and refine_factor > 1 and resolution > refine_factor:
+    y_preds, multi_class = _predict_grid_adaptively(model, x_in, resolution, refine_factor, chunk_size)
+  else:
+    y_preds, multi_class = predict_classes_in_chunks(model, x_in, chunk_size)
+  y_preds = y_preds.reshape(xx.shape)
 
   # Check if it's multiclass
-  if len(y_preds[0]) > 1:
+  if multi_class:
     print("Multi-Class Classification Problem")
-    y_preds = np.argmax(y_preds,axis=1).reshape(xx.shape)
   else :
     print("Binary Class Classification Problem")
-    y_preds = np.round(y_preds).reshape(xx.shape)
 
   # Plot the curve
   plt.contourf(xx,yy,y_preds,cmap=plt.cm.RdYlBu,alpha=0.7)
@@ -135,14 +647,52 @@ def plot_decision_boundary(model,X,y):
   plt.xlim(xx.min(),xx.max())
   plt.ylim(yy.min(),yy.max());
 
-# Plot Images with true label and pred and color based on pred made
+def _predict_grid_adaptively(model, x_in, resolution, refine_factor, chunk_size):
+  """
+  Predicts class labels on a resolution x resolution grid (x_in) by predicting on a coarse grid first
+  and refining only the coarse cells the decision boundary passes through.
+  """
+  # 1. Predict on every refine_factor-th grid point (always including the last one)
+  coarse_idx = np.unique(np.r_[np.arange(0, resolution, refine_factor), resolution-1])
+  grid = x_in.reshape(resolution, resolution, 2)
+  coarse_preds, multi_class = predict_classes_in_chunks(model, grid[np.ix_(coarse_idx, coarse_idx)].reshape(-1, 2), chunk_size)
+  coarse_preds = coarse_preds.reshape(len(coarse_idx), len(coarse_idx))
+
+  # 2. Find coarse cells where all 4 corners agree on the class
+  corner = coarse_preds[:-1, :-1]
+  uniform = ((corner == coarse_preds[:-1, 1:]) &
+             (corner == coarse_preds[1:, :-1]) &
+             (corner == coarse_preds[1:, 1:]))
+
+  # 3. Fill every fine grid point from the coarse cell it falls in, -1 marks points still to predict
+  cell = np.clip(np.searchsorted(coarse_idx, np.arange(resolution), side="right") - 1, 0, len(coarse_idx) - 2)
+  rows, cols = cell[:, np.newaxis], cell[np.newaxis, :]
+  y_preds = np.where(uniform[rows, cols], corner[rows, cols], -1)
+  y_preds[np.ix_(coarse_idx, coarse_idx)] = coarse_preds
+
+  # 4. Predict on the fine grid points inside the boundary cells only
+  todo = (y_preds == -1).ravel()
+  y_preds = y_preds.ravel()
+  if todo.any():
+    y_preds[todo], _ = predict_classes_in_chunks(model, x_in[todo], chunk_size)
+  return y_preds, multi_class
 
-def plot_image(i,model,true_labels,images,classes):
+# Plot Images with true label and pred and color based on pred made
 
+@profiled
+def plot_image(i,model,true_labels,images,classes,pred_cache=None):
+  """
+  Plots images[i] with its predicted label, prediction probability and true label,
+  the label is green if the prediction is right and red if it's wrong.
+  If pred_cache (see make_prediction_cache) contains i, its cached prediction is used instead of calling the model.
+  """
   #Sometimes i = random.randint(0,len(images)) and i is not defined in the function parameters
   target_image = images[i]
-  pred_prob = model.predict(target_image.reshape(1,28,28))
-  pred = np.argmax(pred_prob)
+  if pred_cache is not None and i in pred_cache:
+    pred_prob = pred_cache[i]
+  else:
+    pred_prob = model.predict(np.expand_dims(target_image, axis=0), verbose=0)[0]
+  pred = pred_probs_to_labels(np.expand_dims(pred_prob, axis=0))[0]
   pred_label = classes[pred]
   true_label = classes[true_labels[i]]
 
@@ -156,29 +706,241 @@ def plot_image(i,model,true_labels,images,classes):
   else:
     color="red"
   
-  plt.xlabel(f"{pred_label} ({100*tf.reduce_max(pred_prob):0.2f}%) {true_label}",color=color)
+  plt.xlabel(f"{pred_label} ({100*_class_probabilities(pred_prob)[pred]:0.2f}%) {true_label}",color=color)
+
+# Plot the prediction probabilities of an image as a bar chart
+
+@profiled
+def plot_value_array(i,pred_prob,true_labels):
+  """
+  Plots a bar chart of pred_prob (prediction probabilities for image i),
+  the predicted class is colored red and the true class blue.
+  A binary (sigmoid) prediction is plotted as the probabilities of both classes.
+  """
+  pred_prob = _class_probabilities(pred_prob)
+  plt.grid(False)
+  plt.xticks(range(len(pred_prob)))
+  plt.yticks([])
+  bars = plt.bar(range(len(pred_prob)), pred_prob, color="#777777")
+  plt.ylim([0, 1])
+  bars[np.argmax(pred_prob)].set_color("red")
+  bars[true_labels[i]].set_color("blue")
 
 # Plot Multiple Images with graph of prediction probabilites, Was made for MultiClass Classification problems
 
-def plot_multiple_predictions():
-  n_rows=5
-  n_cols=3
+@profiled
+def plot_multiple_predictions(model,test_data,test_labels,class_names,n_rows=5,n_cols=3,pred_cache=None):
+  """
+  Plots n_rows*n_cols images from test_data with their predictions (left) and prediction probabilities (right).
+  All images are predicted in a single batched forward pass unless a pred_cache is passed in.
+  """
   num_images=n_rows*n_cols
+  if pred_cache is None:
+    pred_cache = make_prediction_cache(model, test_data[:num_images])
   plt.figure(figsize=(n_cols*2*2,n_rows*2))
   plt.title("Plot Prediction -> Left = Pred Label, Right=True Label")
   for i in range(num_images):
     plt.subplot(n_rows,2*n_cols,2*i+1)
-    plot_image(i,model_1,test_labels,test_data,class_names)
+    plot_image(i,model,test_labels,test_data,class_names,pred_cache=pred_cache)
     plt.subplot(n_rows,2*n_cols,2*i+2)
-    plot_value_array(i,y_probs[i],test_labels)
+    plot_value_array(i,pred_cache[i],test_labels)
   plt.tight_layout()
   plt.show();
 
 # Make TensorBoard Callback
 
-import datetime
+def _dir_size(path):
+  """
+  Total size in bytes of the files under path
+  """
+  return sum(os.path.getsize(os.path.join(dirpath, filename))
+             for dirpath, dirnames, filenames in os.walk(path) for filename in filenames)
+
+TENSORBOARD_RUN_FORMAT = "%Y%m%d-%H%M%S"
+
+def _is_tensorboard_run(name):
+  """
+  Whether name is a run directory name made by create_tensorboard_callback
+  """
+  try:
+    datetime.datetime.strptime(name, TENSORBOARD_RUN_FORMAT)
+  except ValueError:
+    return False
+  return True
 
-def create_tensorboard_callback(dir_name, experiment_name):
+def _rotate_tensorboard_runs(experiment_dir, max_experiment_bytes=None, max_runs=None):
+  """
+  Deletes the oldest run directories of experiment_dir until there's room for one more run within max_runs
+  and the remaining runs take up at most max_experiment_bytes.
+  Only directories named by create_tensorboard_callback's datetime format are counted or deleted.
+  """
+  if not os.path.isdir(experiment_dir):
+    return
+  # Run directories are named by datetime, so sorting them sorts them oldest first
+  runs = sorted(entry.path for entry in os.scandir(experiment_dir) if entry.is_dir() and _is_tensorboard_run(entry.name))
+  sizes = [_dir_size(run) for run in runs] if max_experiment_bytes is not None else [0] * len(runs)
+  while runs and ((max_runs is not None and len(runs) >= max_runs) or
+                  (max_experiment_bytes is not None and sum(sizes) > max_experiment_bytes)):
+    print(f"Deleting old TensorBoard run: {runs[0]}")
+    shutil.rmtree(runs.pop(0), ignore_errors=True)
+    sizes.pop(0)
+
+@functools.lru_cache(maxsize=None)
+def _timed_tensorboard_class():
+  """
+  Returns a TensorBoard callback class which measures the time its logging takes
+  (created on first use so TensorFlow is only imported when it's needed)
+  """
+  class TimedTensorBoard(tf.keras.callbacks.TensorBoard):
+    """
+    TensorBoard callback which records the seconds spent logging in each epoch in logging_seconds
+    """
+    def __init__(self, *args, **kwargs):
+      super().__init__(*args, **kwargs)
+      self.logging_seconds = []
+      self._epoch_logging_seconds = 0.
+
+    def _timed(self, method, *args):
+      start = time.perf_counter()
+      method(*args)
+      self._epoch_logging_seconds += time.perf_counter() - start
+
+    def on_epoch_begin(self, epoch, logs=None):
+      self._epoch_logging_seconds = 0.
+      self._timed(super().on_epoch_begin, epoch, logs)
+
+    def on_train_batch_begin(self, batch, logs=None):
+      self._timed(super().on_train_batch_begin, batch, logs)
+
+    def on_train_batch_end(self, batch, logs=None):
+      self._timed(super().on_train_batch_end, batch, logs)
+
+    def on_test_begin(self, logs=None):
+      self._timed(super().on_test_begin, logs)
+
+    def on_test_end(self, logs=None):
+      self._timed(super().on_test_end, logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+      self._timed(super().on_epoch_end, epoch, logs)
+      self.logging_seconds.append(self._epoch_logging_seconds)
+
+  return TimedTensorBoard
+
+@functools.lru_cache(maxsize=None)
+def _async_tensorboard_class():
+  """
+  Returns a callback class which writes TensorBoard logs from a background thread
+  (created on first use so TensorFlow is only imported when it's needed)
+  """
+  class AsyncTensorBoard(tf.keras.callbacks.Callback):
+    """
+    Logs the batch and epoch metrics (and weight histograms) like tf.keras.callbacks.TensorBoard, but the training
+    thread only copies the values into a bounded queue, a worker thread writes them with its own summary writers.
+    """
+    def __init__(self, log_dir, update_freq="epoch", histogram_freq=0, max_queue=100, flush_millis=10_000,
+                 max_pending_events=10_000, measure_overhead=False):
+      super().__init__()
+      self.log_dir = log_dir
+      self.update_freq = 1 if update_freq == "batch" else update_freq
+      self.histogram_freq = histogram_freq
+      self.max_queue = max_queue
+      self.flush_millis = flush_millis
+      self.max_pending_events = max_pending_events
+      self.measure_overhead = measure_overhead
+      self.logging_seconds = []
+      self._epoch_logging_seconds = 0.
+      self._global_train_batch = 0
+      self._events = None
+      self._worker = None
+      self._worker_error = None
+
+    def _write_events(self):
+      writers = {}
+      try:
+        while True:
+          event = self._events.get()
+          if event is None:
+            break
+          writer_name, kind, name, value, step = event
+          if writer_name not in writers:
+            writers[writer_name] = tf.summary.create_file_writer(os.path.join(self.log_dir, writer_name),
+                                                                 max_queue=self.max_queue, flush_millis=self.flush_millis)
+          with writers[writer_name].as_default():
+            if kind == "scalar":
+              tf.summary.scalar(name, value, step=step)
+            else:
+              tf.summary.histogram(name, value, step=step)
+      except Exception as e: # re-raised on the training thread in on_train_end
+        self._worker_error = e
+        while self._events.get() is not None: # keep draining so the training thread never blocks on a full queue
+          pass
+      finally:
+        for writer in writers.values():
+          writer.close()
+
+    def _put(self, writer_name, kind, name, value, step):
+      # Blocks when the writer falls behind by max_pending_events, so memory stays bounded
+      self._events.put((writer_name, kind, name, value, step))
+
+    def _log_metrics(self, logs, prefix, step):
+      for name, value in (logs or {}).items():
+        if name.startswith("val_"):
+          self._put("validation", "scalar", prefix + name[4:], float(value), step)
+        else:
+          self._put("train", "scalar", prefix + name, float(value), step)
+
+    def _timed(self, method, *args):
+      if not self.measure_overhead:
+        return method(*args)
+      start = time.perf_counter()
+      method(*args)
+      self._epoch_logging_seconds += time.perf_counter() - start
+
+    def on_train_begin(self, logs=None):
+      self._global_train_batch = 0
+      self._worker_error = None
+      self._events = queue.Queue(maxsize=self.max_pending_events)
+      self._worker = threading.Thread(target=self._write_events, daemon=True)
+      self._worker.start()
+
+    def on_epoch_begin(self, epoch, logs=None):
+      self._epoch_logging_seconds = 0.
+
+    def _on_train_batch_end(self, batch, logs):
+      self._global_train_batch += 1
+      if self.update_freq != "epoch" and self._global_train_batch % self.update_freq == 0:
+        self._log_metrics(logs, "batch_", self._global_train_batch)
+
+    def on_train_batch_end(self, batch, logs=None):
+      self._timed(self._on_train_batch_end, batch, logs)
+
+    def _on_epoch_end(self, epoch, logs):
+      self._log_metrics(logs, "epoch_", epoch)
+      if self.histogram_freq and epoch % self.histogram_freq == 0:
+        # Copy the weights now, training carries on changing them while the worker writes
+        for weight in self.model.weights:
+          self._put("train", "histogram", getattr(weight, "path", weight.name), np.array(weight), epoch)
+
+    def on_epoch_end(self, epoch, logs=None):
+      self._timed(self._on_epoch_end, epoch, logs)
+      if self.measure_overhead:
+        self.logging_seconds.append(self._epoch_logging_seconds)
+
+    def on_train_end(self, logs=None):
+      # Wait for the worker to write (and close) everything queued
+      self._events.put(None)
+      self._worker.join()
+      if self._worker_error is not None:
+        raise self._worker_error
+
+  return AsyncTensorBoard
+
+@profiled
+def create_tensorboard_callback(dir_name, experiment_name, update_freq="epoch", histogram_freq=0, write_graph=True,
+                                profile_batch=0, max_profile_batches=10, max_experiment_bytes=None, max_runs=None,
+                                measure_overhead=False, async_write=False, max_queue=100, flush_millis=10_000,
+                                max_pending_events=10_000):
   """
   Creates a TensorBoard callback instand to store log files.
   Stores log files with the filepath:
@@ -186,32 +948,125 @@ def create_tensorboard_callback(dir_name, experiment_name):
   Args:
     dir_name: target directory to store TensorBoard log files
     experiment_name: name of experiment directory (e.g. efficientnet_model_1)
+    update_freq: "epoch" to log once per epoch or an int to only log every update_freq batches (default="epoch")
+    histogram_freq: log weight histograms every histogram_freq epochs, 0 for never (default=0)
+    write_graph: log the model graph (default=True)
+    profile_batch: batch (int) or (start, stop) batches to profile, 0 for no profiling (default=0)
+    max_profile_batches: longest profile_batch window allowed, longer windows are cut short (default=10)
+    max_experiment_bytes: delete the oldest runs of experiment_name until its older runs use at most this many bytes (default=None)
+    max_runs: delete the oldest runs of experiment_name so there are at most max_runs including this one (default=None)
+    measure_overhead: record the seconds spent logging each epoch in the callback's logging_seconds list (default=False)
+    async_write: write the logs from a background thread so training doesn't wait on the event files (default=False),
+      it logs the batch/epoch metrics and weight histograms only, write_graph and profile_batch aren't supported
+    max_queue, flush_millis: events buffered and most milliseconds between flushes of each async summary writer (default=100, 10000)
+    max_pending_events: most events waiting for the async writer before training waits for it to catch up (default=10000)
+  Note:
+    Without async_write, events are written synchronously. The summary writer buffers them in memory but flushes
+    on the training thread once its queue fills or its flush interval passes.
   """
-  log_dir = dir_name + "/" + experiment_name + "/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-  tensorboard_callback = tf.keras.callbacks.TensorBoard(
-      log_dir=log_dir
+  log_dir = dir_name + "/" + experiment_name + "/" + datetime.datetime.now().strftime(TENSORBOARD_RUN_FORMAT)
+
+  # Keep the experiment's disk usage bounded by rotating out its oldest runs
+  if max_experiment_bytes is not None or max_runs is not None:
+    _rotate_tensorboard_runs(dir_name + "/" + experiment_name, max_experiment_bytes, max_runs)
+
+  # Profiling is expensive, keep its window bounded
+  if isinstance(profile_batch, (tuple, list)):
+    start, stop = profile_batch
+    if stop - start + 1 > max_profile_batches:
+      stop = start + max_profile_batches - 1
+      print(f"Profiling batches {start} to {stop} (max_profile_batches={max_profile_batches})")
+    profile_batch = (start, stop)
+
+  if async_write:
+    if profile_batch:
+      raise ValueError("profile_batch isn't supported with async_write=True")
+    tensorboard_callback = _async_tensorboard_class()(
+        log_dir=log_dir,
+        update_freq=update_freq,
+        histogram_freq=histogram_freq,
+        max_queue=max_queue,
+        flush_millis=flush_millis,
+        max_pending_events=max_pending_events,
+        measure_overhead=measure_overhead
+    )
+    print(f"Saving TensorBoard log files to: {log_dir}")
+    return tensorboard_callback
+
+  tensorboard_class = _timed_tensorboard_class() if measure_overhead else tf.keras.callbacks.TensorBoard
+  tensorboard_callback = tensorboard_class(
+      log_dir=log_dir,
+      update_freq=update_freq,
+      histogram_freq=histogram_freq,
+      write_graph=write_graph,
+      profile_batch=profile_batch
   )
   print(f"Saving TensorBoard log files to: {log_dir}")
   return tensorboard_callback
 
 # Unzip data
 
-import zipfile
+def _extract_members(filename, members, target_dir):
+  """
+  Extracts members of zip file filename into target_dir with its own ZipFile handle (one per worker)
+  """
+  with zipfile.ZipFile(filename, "r") as zip_ref:
+    for member in members:
+      zip_ref.extract(member, path=target_dir)
 
-def unzip_data(filename):
+@profiled(bytes_read=_file_size)
+def unzip_data(filename, target_dir=None, member_filter=None, n_workers=None):
   """
   Unzips filename into the current working directory.
   Args:
     filename (str): a filepath to a target zip folder to be unzipped.
+    target_dir (str): directory to unzip into instead of the current working directory (default=None).
+    member_filter: only extract members whose names match this glob pattern (e.g. "*/train/*.jpg")
+      or for which this function returns True (default=None).
+    n_workers (int): number of members extracted in parallel (default: number of CPUs).
+  """
+  with zipfile.ZipFile(filename, "r") as zip_ref:
+    members = zip_ref.namelist()
+    if member_filter is None and n_workers == 1:
+      zip_ref.extractall(path=target_dir)
+      return
+
+  if isinstance(member_filter, str):
+    pattern = member_filter
+    member_filter = lambda member: fnmatch.fnmatch(member, pattern)
+  if member_filter is not None:
+    members = [member for member in members if member_filter(member)]
+
+  # Create the directories up front so the workers don't race each other making them
+  target_dir = target_dir or os.getcwd()
+  for member_dir in {os.path.dirname(member) for member in members}:
+    parts = [part for part in member_dir.split("/") if part not in ("", ".", "..")]
+    os.makedirs(os.path.join(target_dir, *parts), exist_ok=True)
+
+  # Decompressing and writing release the GIL, so threads extract in parallel
+  n_workers = max(min(n_workers or os.cpu_count() or 1, len(members)), 1)
+  with ThreadPoolExecutor(max_workers=n_workers) as executor:
+    list(executor.map(_extract_members, [filename] * n_workers,
+                      [members[i::n_workers] for i in range(n_workers)], [target_dir] * n_workers))
+
+# Read an image straight out of a zip file
+
+@profiled
+def load_and_prep_image_from_zip(zip_file, member, img_shape=224, scale=True):
+  """
+  Same as load_and_prep_image but reads member straight out of zip_file without unzipping it.
+  zip_file can be a filepath or an open zipfile.ZipFile (faster when reading many images).
   """
-  zip_ref = zipfile.ZipFile(filename, "r")
-  zip_ref.extractall()
-  zip_ref.close()
+  if isinstance(zip_file, zipfile.ZipFile):
+    img = zip_file.read(member)
+  else:
+    with zipfile.ZipFile(zip_file, "r") as zip_ref:
+      img = zip_ref.read(member)
+  return decode_and_prep_image(img, img_shape=img_shape, scale=scale)
 
 # Walkthrough Directories
 
-import os
-
+@profiled
 def walk_through_dir(dir_path):
   """
   Walks through dir_path returning its contents.
@@ -227,18 +1082,62 @@ def walk_through_dir(dir_path):
   for dirpath, dirnames, filenames in os.walk(dir_path):
     print(f"There are {len(dirnames)} directories and {len(filenames)} images in '{dirpath}'.")
 
+# Index the images in a directory (or zip file) by class
+
+@profiled
+def scan_image_dir(dir_path, extensions=IMAGE_EXTENSIONS):
+  """
+  Scans dir_path (a directory or a zip file) for image files and indexes them by the directory they're in
+  (relative to dir_path, or to the root of a zip file), e.g. "pizza_steak/train" gives the classes "pizza" and "steak".
+  Args:
+    dir_path (str): target directory or zip file
+    extensions: file extensions to index (default=IMAGE_EXTENSIONS)
+  Returns:
+    A dictionary of class name -> {"paths": sorted list of filepaths (or zip member names),
+    "count": number of images, "bytes": total size of the images in bytes},
+    which can be passed straight to load_and_prep_image_dataset
+  """
+  index = {}
+  def add(class_name, path, size):
+    class_index = index.setdefault(class_name, {"paths": [], "count": 0, "bytes": 0})
+    class_index["paths"].append(path)
+    class_index["count"] += 1
+    class_index["bytes"] += size
+
+  if zipfile.is_zipfile(dir_path):
+    with zipfile.ZipFile(dir_path, "r") as zip_ref:
+      for info in zip_ref.infolist():
+        if not info.is_dir() and info.filename.lower().endswith(extensions):
+          add(os.path.dirname(info.filename), info.filename, info.file_size)
+  else:
+    # os.scandir returns file types (and sizes from the same stat call) without the extra work of os.walk
+    dirs_to_scan = [dir_path]
+    while dirs_to_scan:
+      current_dir = dirs_to_scan.pop()
+      with os.scandir(current_dir) as entries:
+        for entry in entries:
+          if entry.is_dir():
+            dirs_to_scan.append(entry.path)
+          elif entry.name.lower().endswith(extensions):
+            add(os.path.relpath(current_dir, dir_path), entry.path, entry.stat().st_size)
+
+  for class_index in index.values():
+    class_index["paths"].sort()
+  return index
+
 # Calculate Results - y_true,y_preds
 
 # Create a function to get few other classification evaluation methods
-from sklearn.metrics import accuracy_score, precision_recall_fscore_support
-def calculate_results(y_true,y_preds):
+@profiled
+def calculate_results(y_true,y_preds,average="weighted"):
   """
   Calculates model accuracy, recall, precision and f1 score of a binary classification model.
+  average is the precision_recall_fscore_support averaging method ("weighted", "macro" or "micro").
   """
   # Calculate model accuracy
-  model_accuracy = accuracy_score(y_true,y_preds) * 100
+  model_accuracy = sklearn_metrics.accuracy_score(y_true,y_preds) * 100
   # Calculate model precision, recall and f1 score
-  model_precision, model_recall, model_f1, _ = precision_recall_fscore_support(y_true,y_preds, average="weighted")
+  model_precision, model_recall, model_f1, _ = sklearn_metrics.precision_recall_fscore_support(y_true,y_preds, average=average)
   # Add all results in a dictionary
   model_results = {"Accuracy Score" : model_accuracy,
                    "Precision Score" : model_precision,
@@ -246,60 +1145,260 @@ def calculate_results(y_true,y_preds):
                    "F1 Score" : model_f1}
   return model_results
 
+# Calculate Results a shard at a time
+
+def _safe_divide(numerator, denominator):
+  """
+  Divides numerator by denominator, returning 0 where denominator is 0 (like sklearn's zero_division)
+  """
+  numerator = np.asarray(numerator, dtype=np.float64)
+  denominator = np.asarray(denominator, dtype=np.float64)
+  return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+class ClassificationMetricsAccumulator:
+  """
+  Accumulates per-class true positive, prediction and support counts shard by shard, so calculate_results can be
+  computed in one pass over predictions that never all fit in memory. Accumulators from different
+  workers/processes can be merged before calling result().
+  Args:
+    n_classes: number of classes, labels must be integers from 0 to n_classes-1
+  Example usage:
+    metrics = ClassificationMetricsAccumulator(n_classes=len(class_names))
+    for y_true_shard, y_pred_shard in shards:
+      metrics.update(y_true_shard, y_pred_shard)
+    metrics.result() # same dictionary as calculate_results
+  """
+  def __init__(self, n_classes):
+    self.n_classes = n_classes
+    self.true_positives = np.zeros(n_classes, dtype=np.int64)
+    self.pred_counts = np.zeros(n_classes, dtype=np.int64) # true positives + false positives
+    self.support = np.zeros(n_classes, dtype=np.int64) # true positives + false negatives
+
+  @classmethod
+  def from_confusion_matrix(cls, cm):
+    """
+    Creates an accumulator from a confusion matrix (e.g. ConfusionMatrixAccumulator.cm).
+    """
+    metrics = cls(cm.shape[0])
+    metrics.true_positives += np.diag(cm)
+    metrics.pred_counts += cm.sum(axis=0)
+    metrics.support += cm.sum(axis=1)
+    return metrics
+
+  def update(self, y_true, y_pred):
+    """
+    Adds a shard of truth labels and predicted labels to the counts.
+    """
+    y_true = np.asarray(y_true, dtype=np.int64).ravel()
+    y_pred = np.asarray(y_pred, dtype=np.int64).ravel()
+    if len(y_true) != len(y_pred):
+      raise ValueError(f"y_true and y_pred must be the same length, got {len(y_true)} and {len(y_pred)}")
+    if len(y_true) == 0:
+      return self
+    if min(y_true.min(), y_pred.min()) < 0 or max(y_true.max(), y_pred.max()) >= self.n_classes:
+      raise ValueError(f"Labels must be between 0 and n_classes-1 ({self.n_classes-1})")
+
+    self.true_positives += np.bincount(y_true[y_true == y_pred], minlength=self.n_classes)
+    self.pred_counts += np.bincount(y_pred, minlength=self.n_classes)
+    self.support += np.bincount(y_true, minlength=self.n_classes)
+    return self
+
+  def merge(self, other):
+    """
+    Adds the counts of another ClassificationMetricsAccumulator (e.g. from another worker) to this one.
+    """
+    if other.n_classes != self.n_classes:
+      raise ValueError(f"Can't merge accumulators with {self.n_classes} and {other.n_classes} classes")
+    self.true_positives += other.true_positives
+    self.pred_counts += other.pred_counts
+    self.support += other.support
+    return self
+
+  def result(self, average="weighted"):
+    """
+    Returns the same dictionary as calculate_results for everything accumulated so far.
+    average is "weighted", "macro" or "micro".
+    """
+    model_accuracy = _safe_divide(self.true_positives.sum(), self.support.sum()) * 100
+    if average == "micro":
+      precision = _safe_divide(self.true_positives.sum(), self.pred_counts.sum())
+      recall = _safe_divide(self.true_positives.sum(), self.support.sum())
+    else:
+      precision = _safe_divide(self.true_positives, self.pred_counts)
+      recall = _safe_divide(self.true_positives, self.support)
+    f1 = _safe_divide(2 * precision * recall, precision + recall)
+
+    if average == "weighted":
+      weights = self.support
+    elif average == "macro":
+      weights = (self.support + self.pred_counts) > 0 # classes that appear in the labels or predictions
+    elif average != "micro":
+      raise ValueError(f"average must be 'weighted', 'macro' or 'micro', got {average!r}")
+    if average != "micro":
+      precision, recall, f1 = (_safe_divide(np.sum(metric * weights), np.sum(weights)) for metric in (precision, recall, f1))
+
+    return {"Accuracy Score" : float(model_accuracy),
+            "Precision Score" : float(precision),
+            "Recall Score" : float(recall),
+            "F1 Score" : float(f1)}
+
 # Comparing Histories
 
-def compare_historys(original_history, new_history, initial_epochs=5):
+@profiled
+def compare_historys(original_history, new_history, initial_epochs=5, axes=None, max_points=None, method="minmax"):
     """
     Compares two TensorFlow model History objects.
     
     Args:
-      original_history: History object from original model (before new_history)
-      new_history: History object from continued model training (after original_history)
+      original_history: History object (or its history dictionary) from original model (before new_history)
+      new_history: History object (or its history dictionary) from continued model training (after original_history)
       initial_epochs: Number of epochs in original_history (new_history plot starts from here) 
+      axes: two matplotlib Axes to plot the accuracy and loss on instead of a new figure which is shown (default=None)
+      max_points: downsample long (e.g. per step) histories to about this many points per curve (default=None)
+      method: downsampling method, "minmax" or "lttb" (see downsample_for_plot) (default="minmax")
     """
+    original_history = getattr(original_history, "history", original_history)
+    new_history = getattr(new_history, "history", new_history)
     
     # Get original history measurements
-    acc = original_history.history["accuracy"]
-    loss = original_history.history["loss"]
+    acc = original_history["accuracy"]
+    loss = original_history["loss"]
 
-    val_acc = original_history.history["val_accuracy"]
-    val_loss = original_history.history["val_loss"]
+    val_acc = original_history["val_accuracy"]
+    val_loss = original_history["val_loss"]
 
     # Combine original history with new history
-    total_acc = acc + new_history.history["accuracy"]
-    total_loss = loss + new_history.history["loss"]
+    total_acc = acc + new_history["accuracy"]
+    total_loss = loss + new_history["loss"]
 
-    total_val_acc = val_acc + new_history.history["val_accuracy"]
-    total_val_loss = val_loss + new_history.history["val_loss"]
+    total_val_acc = val_acc + new_history["val_accuracy"]
+    total_val_loss = val_loss + new_history["val_loss"]
+
+    epochs = np.arange(len(total_acc))
+    acc_epochs, (total_acc, total_val_acc) = _downsample_curves(epochs, [total_acc, total_val_acc], max_points, method)
+    loss_epochs, (total_loss, total_val_loss) = _downsample_curves(epochs, [total_loss, total_val_loss], max_points, method)
 
     # Make plots
-    plt.figure(figsize=(8, 8))
-    plt.subplot(2, 1, 1)
-    plt.plot(total_acc, label='Training Accuracy')
-    plt.plot(total_val_acc, label='Validation Accuracy')
-    plt.plot([initial_epochs-1, initial_epochs-1],
-              plt.ylim(), label='Start Fine Tuning') # reshift plot around epochs
-    plt.legend(loc='lower right')
-    plt.title('Training and Validation Accuracy')
-
-    plt.subplot(2, 1, 2)
-    plt.plot(total_loss, label='Training Loss')
-    plt.plot(total_val_loss, label='Validation Loss')
-    plt.plot([initial_epochs-1, initial_epochs-1],
-              plt.ylim(), label='Start Fine Tuning') # reshift plot around epochs
-    plt.legend(loc='upper right')
-    plt.title('Training and Validation Loss')
-    plt.xlabel('epoch')
-    plt.show()
+    fig = None
+    if axes is None:
+      fig = plt.figure(figsize=(8, 8))
+      axes = fig.subplots(2, 1)
+    acc_ax, loss_ax = axes
+    acc_ax.plot(acc_epochs, total_acc, label='Training Accuracy')
+    acc_ax.plot(acc_epochs, total_val_acc, label='Validation Accuracy')
+    acc_ax.plot([initial_epochs-1, initial_epochs-1],
+              acc_ax.get_ylim(), label='Start Fine Tuning') # reshift plot around epochs
+    acc_ax.legend(loc='lower right')
+    acc_ax.set_title('Training and Validation Accuracy')
+
+    loss_ax.plot(loss_epochs, total_loss, label='Training Loss')
+    loss_ax.plot(loss_epochs, total_val_loss, label='Validation Loss')
+    loss_ax.plot([initial_epochs-1, initial_epochs-1],
+              loss_ax.get_ylim(), label='Start Fine Tuning') # reshift plot around epochs
+    loss_ax.legend(loc='upper right')
+    loss_ax.set_title('Training and Validation Loss')
+    loss_ax.set_xlabel('epoch')
+    if fig is not None:
+      plt.show()
 
 # Best Confusion Matrix (MultiClass with percentages)
 
-import itertools
-import matplotlib.pyplot as plt
-import numpy as np
-from sklearn.metrics import confusion_matrix
+@profiled
+def normalize_confusion_matrix(cm):
+  """
+  Returns cm with each row divided by its total (the fraction of each true class predicted as each class).
+  """
+  return cm.astype("float") / cm.sum(axis=1)[:, np.newaxis]
+
+# Build a confusion matrix a batch at a time
+
+class ConfusionMatrixAccumulator:
+  """
+  Accumulates a confusion matrix batch by batch, so all the labels and predictions never need to be in memory at once.
+  Accumulators from different workers/processes can be merged, and cm can be passed straight to make_confusion_matrix.
+  Args:
+    n_classes: number of classes, labels must be integers from 0 to n_classes-1
+  Example usage:
+    cm_accumulator = ConfusionMatrixAccumulator(n_classes=len(class_names))
+    for y_true_batch, y_pred_batch in batches:
+      cm_accumulator.update(y_true_batch, y_pred_batch)
+    make_confusion_matrix(cm=cm_accumulator.cm, classes=class_names)
+  """
+  def __init__(self, n_classes):
+    self.n_classes = n_classes
+    self.cm = np.zeros((n_classes, n_classes), dtype=np.int64)
+
+  def update(self, y_true, y_pred):
+    """
+    Adds a batch of truth labels and predicted labels to the confusion matrix.
+    """
+    y_true = np.asarray(y_true, dtype=np.int64).ravel()
+    y_pred = np.asarray(y_pred, dtype=np.int64).ravel()
+    if len(y_true) != len(y_pred):
+      raise ValueError(f"y_true and y_pred must be the same length, got {len(y_true)} and {len(y_pred)}")
+    if len(y_true) == 0:
+      return self
+    if min(y_true.min(), y_pred.min()) < 0 or max(y_true.max(), y_pred.max()) >= self.n_classes:
+      raise ValueError(f"Labels must be between 0 and n_classes-1 ({self.n_classes-1})")
+
+    # Count every (true, pred) pair at once by flattening it into a single cell index
+    self.cm += np.bincount(y_true * self.n_classes + y_pred,
+                           minlength=self.n_classes**2).reshape(self.n_classes, self.n_classes)
+    return self
+
+  def merge(self, other):
+    """
+    Adds the counts of another ConfusionMatrixAccumulator (e.g. from another worker) to this one.
+    """
+    if other.n_classes != self.n_classes:
+      raise ValueError(f"Can't merge accumulators with {self.n_classes} and {other.n_classes} classes")
+    self.cm += other.cm
+    return self
+
+  @property
+  def cm_norm(self):
+    return normalize_confusion_matrix(self.cm)
+
+# Find the classes a model confuses the most
 
-def make_confusion_matrix(y_true, y_pred, classes=None, figsize=(10, 10), text_size=15, norm=False, savefig=False): 
+@profiled
+def most_confused_classes(cm, classes=None, top_n=10):
+  """
+  Returns a DataFrame of the top_n biggest off-diagonal cells of confusion matrix cm
+  (true class, predicted class, count and fraction of the true class), most confused first.
+  """
+  off_diagonal = cm.copy()
+  np.fill_diagonal(off_diagonal, 0)
+  top_n = min(top_n, off_diagonal.size)
+  top = np.argpartition(off_diagonal, -top_n, axis=None)[-top_n:]
+  top = top[np.argsort(off_diagonal.ravel()[top])[::-1]]
+  true_idx, pred_idx = np.unravel_index(top, cm.shape)
+  labels = np.asarray(classes) if classes is not None else np.arange(cm.shape[0])
+  return pd.DataFrame({"true": labels[true_idx],
+                       "pred": labels[pred_idx],
+                       "count": cm[true_idx, pred_idx],
+                       "fraction": normalize_confusion_matrix(cm)[true_idx, pred_idx]})
+
+@profiled
+def cluster_confusion_matrix(cm):
+  """
+  Returns an ordering of the classes of confusion matrix cm which groups classes that get confused with
+  each other next to each other (hierarchical clustering of the normalized confusions).
+  """
+  from scipy.cluster.hierarchy import leaves_list, linkage
+  from scipy.spatial.distance import squareform
+  cm_norm = np.nan_to_num(normalize_confusion_matrix(cm))
+  # Confusion in either direction is how similar two classes are, turn it into a distance
+  similarity = cm_norm + cm_norm.T
+  np.fill_diagonal(similarity, 0)
+  max_similarity = similarity.max()
+  distance = 1 - similarity / max_similarity if max_similarity > 0 else np.ones_like(similarity)
+  np.fill_diagonal(distance, 0)
+  return leaves_list(linkage(squareform(distance, checks=False), method="average"))
+
+@profiled
+def make_confusion_matrix(y_true=None, y_pred=None, classes=None, figsize=(10, 10), text_size=15, norm=False, savefig=False, cm=None,
+                          order=None, top_n_classes=None, annotate_threshold=50, annotate_top_k=50, dpi=100, ax=None): 
   """Makes a labelled confusion matrix comparing predictions and ground truth labels.
   If classes is passed, confusion matrix will be labelled, if not, integer class values
   will be used.
@@ -310,7 +1409,16 @@ def make_confusion_matrix(y_true, y_pred, classes=None, figsize=(10, 10), text_s
     figsize: Size of output figure (default=(10, 10)).
     text_size: Size of output figure text (default=15).
     norm: normalize values or not (default=False).
-    savefig: save confusion matrix to file (default=False).
+    savefig: save confusion matrix to file, True saves to "confusion_matrix.png" or pass a filepath (default=False).
+    cm: precomputed confusion matrix (e.g. ConfusionMatrixAccumulator.cm) to plot instead of y_true and y_pred (default=None).
+    order: "cluster" to group confused classes into blocks (see cluster_confusion_matrix) or a sequence
+      of class indexes to reorder the classes by (default=None).
+    top_n_classes: only plot the top_n_classes classes with the most confusions (default=None).
+    annotate_threshold: with more classes than this, only the annotate_top_k biggest confusions are annotated
+      and class tick labels are hidden (default=50).
+    annotate_top_k: number of off-diagonal cells annotated above annotate_threshold classes (default=50).
+    dpi: resolution of the saved figure (default=100).
+    ax: matplotlib Axes to plot on instead of a new figure (default=None).
   
   Returns:
     A labelled confusion matrix plot comparing y_true and y_pred.
@@ -322,29 +1430,47 @@ def make_confusion_matrix(y_true, y_pred, classes=None, figsize=(10, 10), text_s
                           text_size=10)
   """  
   # Create the confustion matrix
-  cm = confusion_matrix(y_true, y_pred)
-  cm_norm = cm.astype("float") / cm.sum(axis=1)[:, np.newaxis] # normalize it
-  n_classes = cm.shape[0] # find the number of classes we're dealing with
-
-  # Plot the figure and make it pretty
-  fig, ax = plt.subplots(figsize=figsize)
-  cax = ax.matshow(cm, cmap=plt.cm.Blues) # colors will represent how 'correct' a class is, darker == better
-  fig.colorbar(cax)
+  if cm is None:
+    cm = sklearn_metrics.confusion_matrix(y_true, y_pred)
 
   # Are there a list of classes?
-  if classes:
-    labels = classes
+  if classes is not None:
+    labels = np.asarray(classes)
   else:
     labels = np.arange(cm.shape[0])
+
+  # Keep only the most confused classes
+  if top_n_classes is not None and top_n_classes < cm.shape[0]:
+    errors = cm.sum(axis=0) + cm.sum(axis=1) - 2 * np.diag(cm) # times each class was mistaken for/with another
+    keep = np.sort(np.argsort(errors)[::-1][:top_n_classes])
+    cm, labels = cm[np.ix_(keep, keep)], labels[keep]
+
+  # Reorder the classes
+  if order is not None:
+    order = cluster_confusion_matrix(cm) if isinstance(order, str) and order == "cluster" else np.asarray(order)
+    cm, labels = cm[np.ix_(order, order)], labels[order]
+
+  cm_norm = normalize_confusion_matrix(cm) # normalize it
+  n_classes = cm.shape[0] # find the number of classes we're dealing with
+  large = n_classes > annotate_threshold
+
+  # Plot the figure and make it pretty
+  if ax is None:
+    fig, ax = plt.subplots(figsize=figsize)
+  else:
+    fig = ax.figure
+  cax = ax.matshow(cm, cmap=plt.cm.Blues, rasterized=True) # colors will represent how 'correct' a class is, darker == better
+  fig.colorbar(cax, ax=ax)
   
   # Label the axes
   ax.set(title="Confusion Matrix",
          xlabel="Predicted label",
-         ylabel="True label",
-         xticks=np.arange(n_classes), # create enough axis slots for each class
-         yticks=np.arange(n_classes), 
-         xticklabels=labels, # axes will labeled with class names (if they exist) or ints
-         yticklabels=labels)
+         ylabel="True label")
+  if not large:
+    ax.set(xticks=np.arange(n_classes), # create enough axis slots for each class
+           yticks=np.arange(n_classes), 
+           xticklabels=labels, # axes will labeled with class names (if they exist) or ints
+           yticklabels=labels)
   
   # Make x-axis labels appear on bottom
   ax.xaxis.set_label_position("bottom")
@@ -353,25 +1479,36 @@ def make_confusion_matrix(y_true, y_pred, classes=None, figsize=(10, 10), text_s
   # Set the threshold for different colors
   threshold = (cm.max() + cm.min()) / 2.
 
+  # Pick the cells to annotate, every cell for small matrices, only the biggest confusions for large ones
+  if large:
+    off_diagonal = cm.copy()
+    np.fill_diagonal(off_diagonal, 0)
+    top_k = min(annotate_top_k, off_diagonal.size)
+    top = np.argpartition(off_diagonal, -top_k, axis=None)[-top_k:]
+    cells = [(i, j) for i, j in zip(*np.unravel_index(top, cm.shape)) if cm[i, j] > 0]
+  else:
+    cells = itertools.product(range(n_classes), range(n_classes))
+
   # Plot the text on each cell
-  for i, j in itertools.product(range(cm.shape[0]), range(cm.shape[1])):
+  for i, j in cells:
     if norm:
-      plt.text(j, i, f"{cm[i, j]} ({cm_norm[i, j]*100:.1f}%)",
+      ax.text(j, i, f"{cm[i, j]} ({cm_norm[i, j]*100:.1f}%)",
               horizontalalignment="center",
               color="white" if cm[i, j] > threshold else "black",
               size=text_size)
     else:
-      plt.text(j, i, f"{cm[i, j]}",
+      ax.text(j, i, f"{cm[i, j]}",
               horizontalalignment="center",
               color="white" if cm[i, j] > threshold else "black",
               size=text_size)
 
-  # Save the figure to the current working directory
+  # Save the figure (to the current working directory by default)
   if savefig:
-    fig.savefig("confusion_matrix.png")
+    fig.savefig(savefig if isinstance(savefig, str) else "confusion_matrix.png", dpi=dpi)
 
 # Create a function to read the lines of a document
 
+@profiled(bytes_read=_file_size)
 def get_lines(filename):
   """
   Reads a text filename, and returns the lines of that text file as a list
@@ -385,23 +1522,19 @@ def get_lines(filename):
 
 # Preprocessing text with line numbers
 
-def preprocess_text_with_line_numbers(filename):
+def _iter_abstract_samples(input_lines):
   """
-  Returns the list of dictionaries of abstract line data.
-  Takes a filename, reads it contents and sorts through each line,
-  extracting things like the target label, the text of the sentence, how many sentences
-  are there in the current abstract and what sentence number the target line is.
+  Yields the line data dictionaries (see preprocess_text_with_line_numbers) from an iterable of lines,
+  only one abstract's lines are held in memory at a time.
   """
-  input_lines = get_lines(filename) # get all the lines from the file
-  abstract_lines = "" # create an empty abstract
-  abstract_samples = [] # create an empty list of abstracts
+  abstract_lines = [] # create an empty abstract
 
   for line in input_lines:
     if line.startswith("###"): # check to see if the line is and ID line
       abstract_id = line
-      abstract_lines = "" # reset the abstract string if the line is an ID line
+      abstract_lines = [] # reset the abstract if the line is an ID line
     elif line.isspace(): # check if its a new line
-      abstract_line_split = abstract_lines.splitlines() # split abstract into separate lines
+      abstract_line_split = "".join(abstract_lines).splitlines() # split abstract into separate lines
 
       # Iterate through each line in a single abstract and count them at the same time
       for abstract_line_number, abstract_line in enumerate(abstract_line_split):
@@ -411,15 +1544,426 @@ def preprocess_text_with_line_numbers(filename):
         line_data["text"] = target_text_split[1].lower() # get target text and lower the string
         line_data["line_number"] = abstract_line_number # what number line does the line appear in the abstract
         line_data["total_lines"] = len(abstract_line_split) - 1 # how many total lines are in the abstract, starting from 0 so -1
-        abstract_samples.append(line_data) # add line data to the abstract samples list
+        yield line_data
     else: # If the above conditions aren't fulfilled, the lines contain a labeled sentence
-      abstract_lines += line # this means all the lines between the id line and the new line belongs to the same abstract
+      abstract_lines.append(line) # this means all the lines between the id line and the new line belongs to the same abstract
 
+def iter_text_with_line_numbers(filename):
+  """
+  Streaming version of preprocess_text_with_line_numbers.
+  Reads filename lazily and yields one line data dictionary at a time,
+  so memory stays proportional to a single abstract.
+  """
+  with open(filename,"r") as f:
+    yield from _iter_abstract_samples(f)
+
+@profiled(bytes_read=_file_size)
+def preprocess_text_with_line_numbers(filename):
+  """
+  Returns the list of dictionaries of abstract line data.
+  Takes a filename, reads it contents and sorts through each line,
+  extracting things like the target label, the text of the sentence, how many sentences
+  are there in the current abstract and what sentence number the target line is.
+  """
+  return list(iter_text_with_line_numbers(filename))
+
+@profiled(bytes_read=_file_size)
+def preprocess_text_to_columns(filename, as_dataframe=True):
+  """
+  Columnar version of preprocess_text_with_line_numbers.
+  Streams filename and collects each field into its own column instead of a dictionary per line.
+  Args:
+    filename: A string containing the target file path
+    as_dataframe: return a pandas DataFrame (default=True), otherwise a dictionary of
+      "target" and "text" lists and "line_number" and "total_lines" int32 NumPy arrays
+  """
+  targets, texts, line_numbers, total_lines = [], [], [], []
+  for line_data in iter_text_with_line_numbers(filename):
+    targets.append(line_data["target"])
+    texts.append(line_data["text"])
+    line_numbers.append(line_data["line_number"])
+    total_lines.append(line_data["total_lines"])
+
+  columns = {"target": targets,
+             "text": texts,
+             "line_number": np.array(line_numbers, dtype=np.int32),
+             "total_lines": np.array(total_lines, dtype=np.int32)}
+  if as_dataframe:
+    return pd.DataFrame(columns)
+  return columns
+
+# Preprocessing text with line numbers in parallel
+
+def _find_abstract_boundaries(filename, n_shards):
+  """
+  Returns sorted byte offsets of "###" abstract ID lines roughly splitting filename into n_shards,
+  starting with 0 and ending with the file size.
+  """
+  file_size = os.path.getsize(filename)
+  boundaries = [0]
+  with open(filename, "rb") as f:
+    for shard in range(1, n_shards):
+      f.seek(max(file_size * shard // n_shards - 1, boundaries[-1]))
+      f.readline() # skip to the start of the next line
+      offset = f.tell()
+      line = f.readline()
+      while line and not line.startswith(b"###"):
+        offset = f.tell()
+        line = f.readline()
+      if not line:
+        break
+      if offset > boundaries[-1]:
+        boundaries.append(offset)
+  boundaries.append(file_size)
+  return boundaries
+
+def _preprocess_text_shard(shard):
+  """
+  Parses the bytes between start and end of filename, shard = (filename, start, end)
+  """
+  filename, start, end = shard
+  with open(filename, "rb") as f:
+    f.seek(start)
+    data = f.read(end - start)
+  # Decode like open(filename, "r") would (default encoding, universal newlines)
+  with io.TextIOWrapper(io.BytesIO(data)) as lines:
+    return list(_iter_abstract_samples(lines))
+
+@profiled(bytes_read=_file_size)
+def preprocess_text_with_line_numbers_parallel(filename, n_workers=None, shards_per_worker=4):
+  """
+  Parallel version of preprocess_text_with_line_numbers, returns the same list of dictionaries.
+  Splits filename into byte ranges at "###" abstract ID lines and parses them in a process pool.
+  Args:
+    filename: A string containing the target file path
+    n_workers: number of processes (default: number of CPUs)
+    shards_per_worker: number of shards per process, more shards balance the load better (default=4)
+  """
+  n_workers = n_workers or os.cpu_count() or 1
+  boundaries = _find_abstract_boundaries(filename, n_workers * shards_per_worker)
+  shards = [(filename, start, end) for start, end in zip(boundaries[:-1], boundaries[1:])]
+  if n_workers == 1 or len(shards) == 1:
+    return [line_data for shard in shards for line_data in _preprocess_text_shard(shard)]
+
+  # map keeps the shards in file order
+  abstract_samples = []
+  with ProcessPoolExecutor(max_workers=n_workers) as executor:
+    for shard_samples in executor.map(_preprocess_text_shard, shards):
+      abstract_samples.extend(shard_samples)
   return abstract_samples
 
+# Save/load preprocessed abstracts in a compact memory-mapped format
+
+@profiled(bytes_read=_file_size)
+def save_abstract_dataset(records, path):
+  """
+  Saves abstract line data to directory path in a compact columnar format which load_abstract_dataset memory-maps:
+    target.npy: uint8 label codes (index into the sorted "labels" of meta.json)
+    line_number.npy, total_lines.npy: uint16
+    text.bin: every text one after the other as UTF-8, text_offsets.npy: int64 start of each text (plus the end)
+  Args:
+    records: filename of an abstracts file (streamed with iter_text_with_line_numbers) or
+      an iterable of line data dictionaries like preprocess_text_with_line_numbers returns
+    path: directory to save the dataset to
+  Returns:
+    The number of records saved
+  """
+  if isinstance(records, str):
+    records = iter_text_with_line_numbers(records)
+  os.makedirs(path, exist_ok=True)
+
+  # Stream the records into compact typed arrays and the text file
+  label_codes = {}
+  targets, line_numbers, total_lines = array.array("B"), array.array("H"), array.array("H")
+  text_offsets = array.array("q", [0])
+  with open(os.path.join(path, "text.bin"), "wb") as text_file:
+    for line_data in records:
+      target = line_data["target"]
+      if target not in label_codes:
+        if len(label_codes) == 256:
+          raise ValueError("Can't save more than 256 different labels as uint8")
+        label_codes[target] = len(label_codes)
+      targets.append(label_codes[target])
+      line_numbers.append(line_data["line_number"]) # raises OverflowError past 65535
+      total_lines.append(line_data["total_lines"])
+      text = line_data["text"].encode("utf-8")
+      text_file.write(text)
+      text_offsets.append(text_offsets[-1] + len(text))
+
+  # Renumber the labels in sorted order
+  labels = sorted(label_codes)
+  sorted_codes = np.array([labels.index(label) for label in label_codes], dtype=np.uint8) # label_codes is in code order
+  np.save(os.path.join(path, "target.npy"), sorted_codes[np.frombuffer(targets, dtype=np.uint8)])
+  np.save(os.path.join(path, "line_number.npy"), np.frombuffer(line_numbers, dtype=np.uint16))
+  np.save(os.path.join(path, "total_lines.npy"), np.frombuffer(total_lines, dtype=np.uint16))
+  np.save(os.path.join(path, "text_offsets.npy"), np.frombuffer(text_offsets, dtype=np.int64))
+  with open(os.path.join(path, "meta.json"), "w") as f:
+    json.dump({"labels": labels, "n_records": len(targets)}, f)
+  return len(targets)
+
+class MappedAbstractDataset:
+  """
+  Abstract line data saved by save_abstract_dataset, memory-mapped so opening it is instant and
+  worker processes share its pages. Use load_abstract_dataset to open one.
+  Attributes:
+    labels: sorted list of label names
+    target: uint8 label codes (labels[code] is the label name)
+    line_number, total_lines: uint16 arrays
+  Indexing returns the same dictionary preprocess_text_with_line_numbers would for that line.
+  """
+  def __init__(self, path):
+    with open(os.path.join(path, "meta.json")) as f:
+      meta = json.load(f)
+    self.labels = meta["labels"]
+    self.target = np.load(os.path.join(path, "target.npy"), mmap_mode="r")
+    self.line_number = np.load(os.path.join(path, "line_number.npy"), mmap_mode="r")
+    self.total_lines = np.load(os.path.join(path, "total_lines.npy"), mmap_mode="r")
+    self.text_offsets = np.load(os.path.join(path, "text_offsets.npy"), mmap_mode="r")
+    text_path = os.path.join(path, "text.bin")
+    # np.memmap can't map an empty file
+    self._text = np.memmap(text_path, dtype=np.uint8, mode="r") if os.path.getsize(text_path) else np.zeros(0, dtype=np.uint8)
+
+  def __len__(self):
+    return len(self.target)
+
+  def text(self, i):
+    """
+    Returns the text of line i
+    """
+    return self._text[self.text_offsets[i]:self.text_offsets[i+1]].tobytes().decode("utf-8")
+
+  def texts(self, start=0, stop=None):
+    """
+    Returns the texts of lines start to stop as a list, decoding one contiguous slice of the text buffer
+    """
+    stop = len(self) if stop is None else min(stop, len(self))
+    if start >= stop:
+      return []
+    offsets = self.text_offsets[start:stop+1] - self.text_offsets[start]
+    buffer = self._text[self.text_offsets[start]:self.text_offsets[stop]].tobytes()
+    return [buffer[begin:end].decode("utf-8") for begin, end in zip(offsets[:-1], offsets[1:])]
+
+  def target_names(self):
+    """
+    Returns the label name of every line as a NumPy array
+    """
+    return np.array(self.labels)[self.target]
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    return {"target": self.labels[self.target[i]],
+            "text": self.text(i),
+            "line_number": int(self.line_number[i]),
+            "total_lines": int(self.total_lines[i])}
+
+@profiled
+def load_abstract_dataset(path):
+  """
+  Opens a dataset saved by save_abstract_dataset without reading it into memory (see MappedAbstractDataset).
+  """
+  return MappedAbstractDataset(path)
+
+# Turn abstract line data into model inputs
+
+@profiled
+def one_hot_encode(indices, depth):
+  """
+  Vectorized NumPy version of tf.one_hot, indices outside 0 to depth-1 become rows of zeros.
+  """
+  indices = np.asarray(indices)
+  one_hot = np.zeros((len(indices), depth), dtype=np.float32)
+  in_range = (indices >= 0) & (indices < depth)
+  one_hot[np.nonzero(in_range)[0], indices[in_range]] = 1.
+  return one_hot
+
+def _abstract_columns(data):
+  """
+  Returns texts, target label names (or codes), label names (or None), line numbers and total lines of data
+  """
+  if isinstance(data, MappedAbstractDataset):
+    return data.texts(), np.asarray(data.target), data.labels, np.asarray(data.line_number), np.asarray(data.total_lines)
+  if isinstance(data, (list, tuple)):
+    data = {column: [line_data[column] for line_data in data] for column in ("text", "target", "line_number", "total_lines")}
+  return list(data["text"]), np.asarray(data["target"]), None, np.asarray(data["line_number"]), np.asarray(data["total_lines"])
+
+def _load_or_adapt_vectorizer(texts, vocab_file, **vectorizer_kwargs):
+  """
+  Returns a TextVectorization layer using the vocabulary in vocab_file if it exists,
+  otherwise adapted to texts (and its vocabulary saved to vocab_file)
+  """
+  if vocab_file is not None and os.path.exists(vocab_file):
+    with open(vocab_file, encoding="utf-8") as f:
+      vocabulary = f.read().split("\n")
+    return tf.keras.layers.TextVectorization(vocabulary=vocabulary, **vectorizer_kwargs)
+  vectorizer = tf.keras.layers.TextVectorization(**vectorizer_kwargs)
+  vectorizer.adapt(tf.data.Dataset.from_tensor_slices(texts).batch(8192))
+  if vocab_file is not None:
+    with open(vocab_file, "w", encoding="utf-8") as f:
+      f.write("\n".join(vectorizer.get_vocabulary(include_special_tokens=False)))
+  return vectorizer
+
+@profiled
+def featurize_abstracts(data, label_names=None, line_number_depth=15, total_lines_depth=20,
+                        max_word_tokens=68000, word_sequence_length=55, max_char_tokens=70, char_sequence_length=290,
+                        vocab_dir=None, batch_size=8192):
+  """
+  Turns abstract line data into every input of a tribrid (token + character + position) model in one pass.
+  Args:
+    data: list of line data dictionaries (preprocess_text_with_line_numbers), DataFrame or columns
+      (preprocess_text_to_columns) or a MappedAbstractDataset (load_abstract_dataset)
+    label_names: label names in code order (default: sorted label names, like sklearn's LabelEncoder)
+    line_number_depth: one hot depth of line_number, larger line numbers are all zeros (default=15)
+    total_lines_depth: one hot depth of total_lines (default=20)
+    max_word_tokens, word_sequence_length: word vocabulary size and token ids per sentence (default=68000, 55)
+    max_char_tokens, char_sequence_length: character vocabulary size and character ids per sentence (default=70, 290)
+    vocab_dir: directory to cache the label names and word/character vocabularies in, so other splits
+      (e.g. validation and test) are encoded the same way without adapting again (default=None)
+    batch_size: number of sentences tokenized at once (default=8192)
+  Returns:
+    A dictionary of NumPy arrays: "labels" (int codes), "labels_one_hot", "line_numbers_one_hot", "total_lines_one_hot",
+    "word_ids", "char_ids", plus the "label_names" list (see make_tribrid_dataset)
+  Example usage:
+    train_features = featurize_abstracts(train_samples, vocab_dir="vocab/")
+    val_features = featurize_abstracts(val_samples, vocab_dir="vocab/") # reuses the training vocabularies
+  """
+  texts, targets, coded_label_names, line_numbers, total_lines = _abstract_columns(data)
+  if vocab_dir is not None:
+    os.makedirs(vocab_dir, exist_ok=True)
+    label_names_file = os.path.join(vocab_dir, "label_names.json")
+    if label_names is None and os.path.exists(label_names_file):
+      with open(label_names_file) as f:
+        label_names = json.load(f)
+
+  # Encode the labels, looking up each distinct label once instead of every line
+  unique_targets, inverse = np.unique(targets, return_inverse=True)
+  if coded_label_names is not None:
+    unique_targets = np.asarray(coded_label_names)[unique_targets]
+  if label_names is None:
+    label_names = sorted(unique_targets.tolist())
+  labels = np.array([label_names.index(target) for target in unique_targets.tolist()], dtype=np.int64)[inverse.ravel()]
+  if vocab_dir is not None:
+    with open(label_names_file, "w") as f:
+      json.dump(label_names, f)
+
+  # Tokenize words and characters (characters are split with a vectorized regex instead of " ".join(list(text)))
+  word_vectorizer = _load_or_adapt_vectorizer(
+      texts, None if vocab_dir is None else os.path.join(vocab_dir, "word_vocab.txt"),
+      max_tokens=max_word_tokens, output_sequence_length=word_sequence_length)
+  split_chars = lambda sentences: tf.strings.regex_replace(sentences, "(.)", r"\1 ")
+  char_texts = [split_chars(tf.constant(texts[start:start+batch_size])) for start in range(0, len(texts), batch_size)]
+  char_vectorizer = _load_or_adapt_vectorizer(
+      tf.concat(char_texts, axis=0) if char_texts else tf.constant([], dtype=tf.string),
+      None if vocab_dir is None else os.path.join(vocab_dir, "char_vocab.txt"),
+      max_tokens=max_char_tokens, output_sequence_length=char_sequence_length)
+  word_ids = np.zeros((len(texts), word_sequence_length), dtype=np.int64)
+  char_ids = np.zeros((len(texts), char_sequence_length), dtype=np.int64)
+  for batch, start in enumerate(range(0, len(texts), batch_size)):
+    word_ids[start:start+batch_size] = word_vectorizer(tf.constant(texts[start:start+batch_size])).numpy()
+    char_ids[start:start+batch_size] = char_vectorizer(char_texts[batch]).numpy()
+
+  return {"labels": labels,
+          "labels_one_hot": one_hot_encode(labels, len(label_names)),
+          "line_numbers_one_hot": one_hot_encode(line_numbers, line_number_depth),
+          "total_lines_one_hot": one_hot_encode(total_lines, total_lines_depth),
+          "word_ids": word_ids,
+          "char_ids": char_ids,
+          "label_names": label_names}
+
+@profiled
+def make_tribrid_dataset(features, batch_size=32, shuffle=False, seed=None):
+  """
+  Creates a batched, prefetched tf.data.Dataset of
+  ((line_numbers_one_hot, total_lines_one_hot, word_ids, char_ids), labels_one_hot) from featurize_abstracts features.
+  """
+  dataset = tf.data.Dataset.from_tensor_slices(((features["line_numbers_one_hot"],
+                                                 features["total_lines_one_hot"],
+                                                 features["word_ids"],
+                                                 features["char_ids"]),
+                                                features["labels_one_hot"]))
+  if shuffle:
+    dataset = dataset.shuffle(len(features["labels"]), seed=seed)
+  return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+# Downsample long series for plotting
+
+def _as_numeric(x):
+  """
+  Returns x as a float array, datetimes become nanoseconds
+  """
+  x = np.asarray(x)
+  if np.issubdtype(x.dtype, np.datetime64):
+    return x.astype("datetime64[ns]").astype(np.int64).astype(np.float64)
+  return x.astype(np.float64)
+
+def _minmax_indexes(y, n_buckets):
+  """
+  Indexes of the min and max of each of n_buckets equal buckets of y (for every column of a 2D y)
+  """
+  n = len(y)
+  bucket_size = -(-n // n_buckets)
+  n_buckets = -(-n // bucket_size)
+  # Pad with the last value so y splits into equal buckets, then find every bucket's min/max at once
+  buckets = np.pad(y, ((0, n_buckets * bucket_size - n), (0, 0)), mode="edge").reshape(n_buckets, bucket_size, -1)
+  bucket_starts = (np.arange(n_buckets) * bucket_size)[:, np.newaxis]
+  indexes = np.concatenate([np.argmin(buckets, axis=1) + bucket_starts, np.argmax(buckets, axis=1) + bucket_starts], axis=None)
+  return np.minimum(indexes, n - 1)
+
+def _lttb_indexes(x, y, n_out):
+  """
+  Indexes of the n_out points Largest-Triangle-Three-Buckets picks from the 1D series x, y
+  """
+  n = len(y)
+  # n_out-2 buckets between the first and last points (which are always kept)
+  edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+  bucket_sizes = np.diff(edges)
+  average_x = np.add.reduceat(x[:-1], edges[:-1]) / bucket_sizes
+  average_y = np.add.reduceat(y[:-1], edges[:-1]) / bucket_sizes
+  # Each bucket's point makes the biggest triangle with the point picked before it and the next bucket's average
+  next_x, next_y = np.append(average_x[1:], x[-1]), np.append(average_y[1:], y[-1])
+
+  indexes = np.empty(n_out, dtype=int)
+  indexes[0], indexes[-1] = 0, n - 1
+  picked = 0
+  for bucket, (start, end) in enumerate(zip(edges[:-1], edges[1:])):
+    areas = np.abs((x[picked] - next_x[bucket]) * (y[start:end] - y[picked]) -
+                   (x[picked] - x[start:end]) * (next_y[bucket] - y[picked]))
+    picked = start + np.argmax(areas)
+    indexes[bucket + 1] = picked
+  return indexes
+
+@profiled
+def downsample_for_plot(x, y, max_points=2000, method="minmax"):
+  """
+  Downsamples a long series to about max_points points which keep its visual shape, so it plots quickly.
+  Args:
+    x: array of timesteps (numbers or datetimes)
+    y: array of values, or a 2D array of shape (timesteps, n_series) for multiple series sharing x
+    max_points: number of points to keep per series (default=2000)
+    method: "minmax" keeps the min and max of each of max_points/2 buckets (fastest, keeps every spike),
+      "lttb" uses Largest-Triangle-Three-Buckets (smoother looking lines) (default="minmax")
+  Returns:
+    x and y at the kept points (for multiple series, the union of each series' kept points)
+  """
+  x, y = np.asarray(x), np.asarray(y)
+  if len(y) <= max_points:
+    return x, y
+  y_2d = y.reshape(len(y), -1)
+  if method == "minmax":
+    indexes = _minmax_indexes(y_2d, max(max_points // 2, 1))
+  elif method == "lttb":
+    x_numeric = _as_numeric(x)
+    indexes = np.concatenate([_lttb_indexes(x_numeric, y_2d[:, column].astype(np.float64), max(max_points, 3))
+                              for column in range(y_2d.shape[1])])
+  else:
+    raise ValueError(f"method must be 'minmax' or 'lttb', got {method!r}")
+  indexes = np.unique(np.concatenate([indexes, [0, len(y) - 1]]))
+  return x[indexes], y[indexes]
+
 # Plot Time Series Data
 
-def plot_time_series(timesteps,values,format=".",start=0,end=None,label=None):
+@profiled
+def plot_time_series(timesteps,values,format=".",start=0,end=None,label=None,ax=None,max_points=None,method="minmax"):
   """
   Plots timesteps vs values (values across timesteps)
 
@@ -430,17 +1974,91 @@ def plot_time_series(timesteps,values,format=".",start=0,end=None,label=None):
   format: type of graph, eg - . for scatter, - for line, default = .
   start: start of plot - setting a value will index from the particular timestep
   end: end of plot - setting a value will end the plot at particular timestep
-  label: a label to show plot about the values
+  label: a label to show plot about the values (a list of labels for multiple series)
+  ax: matplotlib Axes to plot on, default = the current Axes
+  max_points: downsample long series to about this many points per series before plotting, default = None (plot every point)
+  method: downsampling method, "minmax" or "lttb" (see downsample_for_plot), default = minmax
+
+  values can also be a 2D array of shape (timesteps, n_series) to plot multiple series at once
   """
+  if ax is None:
+    ax = plt.gca()
+  timesteps, values = timesteps[start:end], values[start:end]
+  if max_points is not None:
+    timesteps, values = downsample_for_plot(timesteps, values, max_points=max_points, method=method)
   # Plot the series
-  plt.plot(timesteps[start:end], values[start:end], format, label=label)
-  plt.xlabel("Time")
-  plt.ylabel("Bitcoin Price")
+  ax.plot(timesteps, values, format, label=label)
+  ax.set_xlabel("Time")
+  ax.set_ylabel("Bitcoin Price")
   if label:
-    plt.legend(fontsize=14); # make label bigger
-  plt.grid(True);
+    ax.legend(fontsize=14); # make label bigger
+  ax.grid(True);
+
+# Render plots headlessly in a worker pool
+
+# Plotting helpers render_plot can draw: name -> (function, Axes keyword argument, number of Axes)
+_RENDERABLE_PLOTS = {
+  "plot_loss_curves": (plot_loss_curves, "axes", 2),
+  "compare_historys": (compare_historys, "axes", 2),
+  "plot_time_series": (plot_time_series, "ax", 1),
+  "make_confusion_matrix": (make_confusion_matrix, "ax", 1),
+  "view_random_image": (view_random_image, "ax", 1),
+}
+
+def _use_agg_backend():
+  """
+  Makes matplotlib render without a display (worker process initializer)
+  """
+  import matplotlib
+  matplotlib.use("Agg")
+
+@profiled
+def render_plot(job):
+  """
+  Renders one plot job to a file on its own matplotlib Figure (no global pyplot state) and frees the figure.
+  Args:
+    job: dictionary of
+      "plot": name of the plotting helper, one of "plot_loss_curves", "compare_historys",
+        "plot_time_series", "make_confusion_matrix" or "view_random_image"
+      "kwargs": keyword arguments for the plotting helper (pass history dictionaries rather than History objects)
+      "filename": file to save the figure to, the extension picks the format (e.g. .png or .svg)
+      "figsize": figure size (default=(10, 7)), "dpi": resolution (default=100)
+  Returns:
+    filename
+  """
+  from matplotlib.figure import Figure
+  plot_function, axes_argument, n_axes = _RENDERABLE_PLOTS[job["plot"]]
+  fig = Figure(figsize=job.get("figsize", (10, 7)))
+  try:
+    axes = fig.subplots(n_axes, 1)
+    plot_function(**job.get("kwargs", {}), **{axes_argument: axes})
+    fig.savefig(job["filename"], dpi=job.get("dpi", 100))
+  finally:
+    fig.clear() # drop the artists now rather than whenever the figure is garbage collected
+  return job["filename"]
+
+@profiled
+def render_plots(jobs, n_workers=None):
+  """
+  Renders a list of plot jobs (see render_plot) to files in parallel with the Agg backend,
+  each worker process draws on its own Figure objects so memory stays flat however many plots there are.
+  Args:
+    jobs: list of plot job dictionaries
+    n_workers: number of processes, 1 renders in this process (default: number of CPUs)
+  Returns:
+    The list of filenames written, in the same order as jobs
+  Example usage:
+    render_plots([{"plot": "plot_loss_curves", "kwargs": {"history": history_1.history}, "filename": "model_1.png"},
+                  {"plot": "plot_time_series", "kwargs": {"timesteps": timesteps, "values": prices}, "filename": "prices.svg"}])
+  """
+  n_workers = n_workers or os.cpu_count() or 1
+  if n_workers == 1:
+    return [render_plot(job) for job in jobs]
+  with ProcessPoolExecutor(max_workers=n_workers, initializer=_use_agg_backend) as executor:
+    return list(executor.map(render_plot, jobs, chunksize=max(len(jobs) // (n_workers * 4), 1)))
 
 # MASE Implementation
+@profiled
 def mean_absolute_scaled_error(y_true,y_preds):
   """
   Implement MASE provided no seasonality of data is there
@@ -454,6 +2072,7 @@ def mean_absolute_scaled_error(y_true,y_preds):
 
 # Create a function to evaluate all evaluation metrics
 
+@profiled
 def calculate_results_time_series(y_true,y_preds):
   """
   Returns a dictionary of MAE, MSE, RMSE, MAPE, MASE metrics for evaluation
@@ -462,11 +2081,13 @@ def calculate_results_time_series(y_true,y_preds):
   y_true = tf.cast(y_true, tf.float32)
   y_preds = tf.cast(y_preds, tf.float32)
   
-  # Calculate different evaluation scores
-  mae = tf.keras.metrics.mean_absolute_error(y_true, y_preds)
-  mse = tf.keras.metrics.mean_squared_error(y_true, y_preds)
+  # Calculate different evaluation scores (over the last axis like the tf.keras.metrics functions,
+  # which Keras 3 no longer has)
+  errors = y_true - y_preds
+  mae = tf.reduce_mean(tf.abs(errors), axis=-1)
+  mse = tf.reduce_mean(tf.square(errors), axis=-1)
   rmse = tf.math.sqrt(mse)
-  mape = tf.keras.metrics.mean_absolute_percentage_error(y_true, y_preds)
+  mape = 100. * tf.reduce_mean(tf.abs(errors / tf.maximum(tf.abs(y_true), 1e-7)), axis=-1)
   mase = mean_absolute_scaled_error(y_true, y_preds)
   
   # Check for different horizons by checking the ndims
@@ -483,8 +2104,84 @@ def calculate_results_time_series(y_true,y_preds):
           "MAPE": mape.numpy(),
           "MASE": mase.numpy()}
 
+# Evaluate many models/horizons at once
+
+_naive_mae_cache = {}
+
+@profiled
+def naive_forecast_mae(y_true):
+  """
+  Returns the MAE of the naive (no seasonality) forecast of y_true, the denominator of MASE.
+  The value is cached per y_true array, so evaluating many models against the same y_true only computes it once
+  (y_true shouldn't be modified in place after it has been evaluated).
+  """
+  key = id(y_true)
+  cached = _naive_mae_cache.get(key)
+  if cached is not None and cached[0]() is y_true:
+    return cached[1]
+
+  y = np.asarray(y_true, dtype=np.float64)
+  naive_mae = np.mean(np.abs(y[1:] - y[:-1]))
+  if isinstance(y_true, np.ndarray):
+    # Drop the cached value when y_true is garbage collected (and its id can be reused)
+    _naive_mae_cache[key] = (weakref.ref(y_true, lambda _: _naive_mae_cache.pop(key, None)), naive_mae)
+  return naive_mae
+
+@profiled
+def evaluate_time_series_models(y_true, y_preds, model_names=None, per_horizon=False):
+  """
+  Batched version of calculate_results_time_series, evaluates many models' predictions in one pass.
+  Args:
+    y_true: truth values of shape (samples,) or (samples, horizon)
+    y_preds: stacked predictions of shape (models, samples) or (models, samples, horizon)
+    model_names: names of the models (default: model indexes)
+    per_horizon: also break the metrics down per horizon step (default=False)
+  Returns:
+    A pandas DataFrame with MAE, MSE, RMSE, MAPE and MASE columns and a row per model
+    (or per model and horizon step if per_horizon), matching calculate_results_time_series for each model
+  """
+  naive_mae = naive_forecast_mae(y_true)
+  multi_horizon = np.ndim(y_true) > 1
+  y_true = np.asarray(y_true, dtype=np.float64)
+  y_true = y_true.reshape(len(y_true), -1) # (samples, horizon)
+  # Reshape explicitly so (samples,) truths and (samples, 1) predictions can't broadcast to (samples, samples)
+  y_preds = np.asarray(y_preds, dtype=np.float64).reshape((-1,) + y_true.shape) # (models, samples, horizon)
+  if model_names is None:
+    model_names = list(range(len(y_preds)))
+
+  # Compute the errors once and reuse them for every metric
+  errors = y_preds - y_true
+  abs_errors = np.abs(errors)
+  squared_errors = np.square(errors, out=errors)
+
+  axis = 1 if per_horizon else (1, 2)
+  mae = abs_errors.mean(axis=axis)
+  mse = squared_errors.mean(axis=axis)
+  if multi_horizon and not per_horizon:
+    rmse = np.sqrt(squared_errors.mean(axis=2)).mean(axis=1) # mean RMSE of each sample's horizon, as calculate_results_time_series
+  else:
+    rmse = np.sqrt(mse)
+  mape = 100. * (abs_errors / np.maximum(np.abs(y_true), 1e-7)).mean(axis=axis)
+  mase = mae / naive_mae
+
+  if per_horizon:
+    index = pd.MultiIndex.from_product([model_names, range(1, y_true.shape[1] + 1)], names=["model", "horizon"])
+  else:
+    index = pd.Index(model_names, name="model")
+  return pd.DataFrame({"MAE": mae.ravel(),
+                       "MSE": mse.ravel(),
+                       "RMSE": rmse.ravel(),
+                       "MAPE": mape.ravel(),
+                       "MASE": mase.ravel()}, index=index)
+
+# Default window size and horizon of the windowing/forecasting functions
+
+WINDOW_SIZE = 7 # use the past week of data
+HORIZON = 1 # to predict the next day
+
 # Create function to label windowed data
 
+@profiled
 def get_labelled_windows(x, horizon=HORIZON):
   """
   Creates labels for windowed dataset
@@ -496,6 +2193,7 @@ def get_labelled_windows(x, horizon=HORIZON):
 
 # Create function to view Numpy arrays as windows
 
+@profiled
 def make_windows(x, window_size=WINDOW_SIZE, horizon=HORIZON):
   """
   Turns a 1D array to a 2D array of sequential labelled windows with window_size and horizon size labels
@@ -515,31 +2213,138 @@ def make_windows(x, window_size=WINDOW_SIZE, horizon=HORIZON):
   
   return windows,labels
 
-# Create function to make predictions in the future
-def make_future_forecasts(values, model, into_future, window_size=WINDOW_SIZE):
+# Create function to view Numpy arrays as windows without copying them
+
+@profiled
+def make_windows_view(x, window_size=WINDOW_SIZE, horizon=HORIZON, mmap_mode="r"):
   """
-  Make future forecasts into_future steps after value ends.
-  
-  Returns a list of future forecasts
+  Zero-copy version of make_windows, returns the same windows and labels as read-only strided views of x.
+  Nothing is copied, so windows and labels take no extra memory however large x is.
+  Args:
+    x: 1D array (or np.memmap) of the series, or a filepath to a .npy file which is memory-mapped
+      so the series is never fully loaded into RAM
+    window_size: number of timesteps in each window (default=WINDOW_SIZE)
+    horizon: number of timesteps to predict/label (default=HORIZON)
+    mmap_mode: mode to memory-map a .npy filepath with (default="r")
+  Returns:
+    windows of shape (len(x)-window_size-horizon+1, window_size) and labels of shape (len(x)-window_size-horizon+1, horizon),
+    call np.array on them if a writeable copy is needed
   """
-  # 2. Create an empty list for future forecasts/prepare data to forecast on
-  future_forecast = []
-  last_window = values[-WINDOW_SIZE:]
+  if isinstance(x, str):
+    x = np.load(x, mmap_mode=mmap_mode)
+  windowed_array = np.lib.stride_tricks.sliding_window_view(x, window_size+horizon)
+  return get_labelled_windows(windowed_array, horizon=horizon)
 
-  # 3. Make into_future number of predictions, altering the data which gets predicted on each
-  for _ in range(into_future):
-    # Predict on the last window then append it again and again and again (our model will eventually make forecasts on its own forecast)
-    future_pred = model.predict(tf.expand_dims(last_window, axis=0))
-    print(f"Predicting on : \n {last_window} -> Prediction : {tf.squeeze(future_pred).numpy()}\n")
+# Create a tf.data pipeline of labelled windows
 
-    # Append predictions to future forecast
-    future_forecast.append(tf.squeeze(future_pred).numpy())
+@profiled
+def make_windowed_dataset(series, window_size=WINDOW_SIZE, horizon=HORIZON, batch_size=128, shuffle=True, label_index=0, seed=None):
+  """
+  Creates a shuffled, batched and prefetched tf.data.Dataset of (window, label) pairs.
+  The windows and labels are the same as make_windows would make, but they are only
+  gathered from the series a batch at a time instead of being materialized up front.
+  Args:
+    series: a 1D array, a 2D array of shape (timesteps, features) for multivariate series,
+      or a list of these (windows never cross from one series into the next)
+    window_size: number of timesteps in each window (default=WINDOW_SIZE)
+    horizon: number of timesteps to predict/label (default=HORIZON)
+    batch_size: number of windows per batch (default=128)
+    shuffle: shuffle the windows (default=True), set to False to get them in make_windows order
+    label_index: feature to use as the label for multivariate series (default=0)
+    seed: random seed for shuffling (default=None)
+  Returns:
+    A tf.data.Dataset of (windows, labels) batches, windows of shape (batch, window_size) or
+    (batch, window_size, features) and labels of shape (batch, horizon)
+  """
+  if not isinstance(series, (list, tuple)):
+    series = [series]
+  series = [np.asarray(x) for x in series]
+
+  # Put all series end to end and work out where each window starts
+  starts, offset = [], 0
+  for x in series:
+    starts.append(offset + np.arange(max(len(x) - (window_size+horizon-1), 0)))
+    offset += len(x)
+  starts = np.concatenate(starts)
+  values = tf.constant(np.concatenate(series))
+  window_step = tf.range(window_size+horizon, dtype=tf.int64)
+
+  def get_windows(batch_starts):
+    # Gather a whole batch of windows at once (same indexing as make_windows)
+    windowed_array = tf.gather(values, batch_starts[:, tf.newaxis] + window_step)
+    if len(values.shape) == 1:
+      return windowed_array[:, :-horizon], windowed_array[:, -horizon:]
+    return windowed_array[:, :window_size], windowed_array[:, window_size:, label_index]
+
+  # Shuffle the (small) window start indexes rather than the windows themselves
+  dataset = tf.data.Dataset.from_tensor_slices(starts)
+  if shuffle and len(starts): # shuffle(0) raises, a series shorter than a window gives an empty dataset
+    dataset = dataset.shuffle(len(starts), seed=seed)
+  dataset = dataset.batch(batch_size).map(get_windows, num_parallel_calls=tf.data.AUTOTUNE)
+  return dataset.prefetch(tf.data.AUTOTUNE)
 
-    # Update last window with new pred and get WINDOW_SIZE most recent preds
-    last_window = np.append(last_window, future_pred)[-WINDOW_SIZE:]
+# Create function to make predictions in the future
+@profiled
+def make_future_forecasts(values, model, into_future, window_size=WINDOW_SIZE, verbose=True):
+  """
+  Make future forecasts into_future steps after value ends.
   
-  return future_forecast
+  Returns a list of future forecasts
+  """
+  future_forecast = make_future_forecasts_batched(np.expand_dims(values[-window_size:], axis=0), model,
+                                                  into_future, window_size=window_size, verbose=verbose)
+  return list(future_forecast[0])
 
+@profiled
+def make_future_forecasts_batched(values, model, into_future, window_size=WINDOW_SIZE, verbose=False, compile_step=True):
+  """
+  Makes into_future forecasts for many series at once, every series advances one step per forward pass.
+  Args:
+    values: 2D array of shape (n_series, timesteps), only the last window_size timesteps of each series are used
+    model: trained model taking windows of shape (batch, window_size)
+    into_future: number of forecasting steps
+    window_size: number of timesteps the model predicts on (default=WINDOW_SIZE)
+    verbose: print every window and prediction (default=False)
+    compile_step: compile the model call into a tf.function, both options skip model.predict's per-call overhead (default=True)
+  Returns:
+    A NumPy array of forecasts of shape (n_series, into_future) or (n_series, into_future, horizon) for multi-horizon models
+  """
+  values = np.asarray(values)
+  n_series = len(values)
+  def predict_step(x):
+    return model(x, training=False)
+  if compile_step:
+    predict_step = tf.function(predict_step)
+
+  last_window = values[:, -window_size:].astype(np.float32)
+  forecasts = []
+  for step in range(into_future):
+    # Predict on the last windows (our model will eventually make forecasts on its own forecasts)
+    future_pred = predict_step(tf.constant(last_window)).numpy().reshape(n_series, -1)
+    if verbose:
+      print(f"Predicting on : \n {np.squeeze(last_window)} -> Prediction : {np.squeeze(future_pred)}\n")
+    forecasts.append(future_pred)
+
+    # Preallocate every window we'll predict on: the last window_size values followed by all the forecasts,
+    # each step's window is then a slice of this buffer instead of a newly appended array
+    if step == 0:
+      horizon = future_pred.shape[1]
+      window_buffer = np.empty((n_series, window_size + into_future * horizon), dtype=np.float32)
+      window_buffer[:, :window_size] = last_window
+
+    # Add the new predictions to the buffer and slide the window past them
+    position = step * horizon + window_size
+    window_buffer[:, position:position+horizon] = future_pred
+    last_window = window_buffer[:, position+horizon-window_size:position+horizon]
+
+  if not forecasts:
+    return np.empty((n_series, 0), dtype=np.float32)
+  forecasts = np.stack(forecasts, axis=1)
+  if forecasts.shape[-1] == 1:
+    forecasts = forecasts[..., 0]
+  return forecasts
+
+@profiled
 def get_future_dates(start_date, into_future, offset=1):
   """
   Returns an array of datetime values ranging from start_data to start_data + into_future
@@ -549,10 +2354,13 @@ def get_future_dates(start_date, into_future, offset=1):
   return np.arange(start_date, end_date, dtype="datetime64[D]")
 
 # Making future forecastts of Bitcoins (using the whole data)
-def pred_model_run(values , X, model , into_future , window_size  , horizon, epochs ):
+@profiled
+def pred_model_run(values , X, model , into_future , window_size  , horizon, epochs,
+                   retrain_window=None, replay_size=0, retrain_every=1, verbose=True, seed=None):
 
   '''
   This function train a model for every updated predictions. 
+  After every prediction the window predicted on and the prediction are added to the training data (walk-forward retraining).
 
   Arguments:
   ----------
@@ -562,31 +2370,50 @@ def pred_model_run(values , X, model , into_future , window_size  , horizon, epo
       - into_future -->  how many time steps to predict in the future? 
       - window_size --> default is 7 (using the 7 days prices of bitcoin)
       - horizon --> default is 1 (predicting the price of next day)
+      - epochs --> number of epochs to fit the model for each time it's retrained
+      - retrain_window --> only fine-tune on the retrain_window most recent samples, None trains on all samples (default None)
+      - replay_size --> number of random older samples (outside retrain_window) to mix into each fine-tune (default 0)
+      - retrain_every --> retrain the model every retrain_every steps instead of every step (default 1)
+      - verbose --> print every window and prediction (default True)
+      - seed --> random seed for sampling the replay samples (default None)
 
   Returns: 
   --------
       - model --> a model that has been trained on all the previous predictions + the data
+      - future_forecast --> list of the into_future forecasts
   '''
+  # Preallocate room for the training samples the forecasts will add
+  n_samples = len(X)
+  X_all = np.empty((n_samples + into_future,) + np.shape(X)[1:], dtype=np.float32)
+  y_all = np.empty((n_samples + into_future,) + np.shape(values)[1:], dtype=np.float32)
+  X_all[:n_samples] = X
+  y_all[:n_samples] = values
+
+  rng = np.random.default_rng(seed)
   future_forecast=[]
-  last_window = values[-window_size:]
-  X_all = X
-  y_all = values
-  for _ in range(into_future): 
-
-      # Each time the model is trained for 5 epochs with the updated data
-      model.fit(x = X_all , y = y_all , epochs = epochs , verbose = 0)
-
-      future_pred = model.predict(tf.expand_dims(last_window, axis= 0))
-      #future_pred = model.predict(last_window)
-      print(f'Predicing on: \n {last_window} --> Prediction: {tf.squeeze(future_pred).numpy()}\n')
-
-      future_forecast.append(tf.squeeze(future_pred).numpy())
-      #values = np.append(values , tf.squeeze(future_pred).numpy())
-      for i in range(0 , len(X_all)):
-        x = X_all[i][1:]  # removing the 0th index of the X window ()
-        y = y_all[1:] # removing the 0th index  of y 
-        X = np.append(x , future_pred) # append the future pred at last to X window
-        values = np.append(y , future_pred) # appending the future pred to y 
+  last_window = np.asarray(values[-window_size:], dtype=np.float32)
+  for step in range(into_future): 
+
+      # Retrain on the most recent samples (plus a replay sample of older ones), so the cost doesn't grow with the history
+      if step % retrain_every == 0:
+        recent_start = 0 if retrain_window is None else max(n_samples - retrain_window, 0)
+        if replay_size and recent_start > 0:
+          train_idx = np.concatenate([rng.integers(0, recent_start, size=replay_size), np.arange(recent_start, n_samples)])
+          X_train, y_train = X_all[train_idx], y_all[train_idx]
+        else:
+          X_train, y_train = X_all[recent_start:n_samples], y_all[recent_start:n_samples]
+        model.fit(x = X_train , y = y_train , epochs = epochs , verbose = 0)
+
+      future_pred = model(tf.expand_dims(last_window, axis= 0), training=False).numpy()
+      if verbose:
+        print(f'Predicing on: \n {last_window} --> Prediction: {np.squeeze(future_pred)}\n')
+
+      future_forecast.append(np.squeeze(future_pred))
+
+      # Add the window we predicted on and its prediction as a new training sample
+      X_all[n_samples] = last_window
+      y_all[n_samples] = np.reshape(future_pred, y_all.shape[1:])
+      n_samples += 1
 
       # Update the last window 
       last_window = np.append(last_window , future_pred)[-window_size:]
@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+# Max seconds "import helper_functions" may take (same budget as benchmarks.py)
+IMPORT_TIME_BUDGET = 1.0
+
+HEAVY_MODULES = ("tensorflow", "pandas", "matplotlib", "sklearn")
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_CODE = """
+import sys, time
+start = time.perf_counter()
+import helper_functions
+seconds = time.perf_counter() - start
+loaded = sorted({name.split(".")[0] for name in sys.modules} & set(sys.argv[1:]))
+print(seconds, ",".join(loaded))
+"""
+
+def import_in_fresh_interpreter():
+  """
+  Imports helper_functions in a new interpreter, returns the seconds it took and the heavy modules it loaded
+  """
+  output = subprocess.run([sys.executable, "-c", IMPORT_CODE, *HEAVY_MODULES], cwd=PACKAGE_DIR,
+                          capture_output=True, text=True, check=True)
+  seconds, _, loaded = output.stdout.strip().splitlines()[-1].partition(" ")
+  return float(seconds), [name for name in loaded.split(",") if name]
+
+def test_import_time_is_within_budget():
+  # Best of 3 so a busy machine doesn't fail the test
+  seconds = min(import_in_fresh_interpreter()[0] for _ in range(3))
+  assert seconds < IMPORT_TIME_BUDGET, f"importing helper_functions took {seconds:.3f}s, over the {IMPORT_TIME_BUDGET}s budget"
+
+def test_import_does_not_load_heavy_modules():
+  _, loaded = import_in_fresh_interpreter()
+  assert loaded == [], f"importing helper_functions loaded {', '.join(loaded)}"